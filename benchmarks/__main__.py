@@ -0,0 +1,208 @@
+"""
+Benchmarks `/fight/` and `/urban/` against local stand-ins for the upstream APIs
+
+Runs the app and the upstream stand-ins in their own uvicorn processes, sends requests at a fixed concurrency
+and reports throughput and latency percentiles, with cold (every request for a new key) and warm caches.
+Results are saved to `.benchmarks/` and compared with the previous run.
+
+    nox -s bench -- --requests 2000 --concurrency 50 --latency 0.1
+"""
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import subprocess  # noqa: S404
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+from .harness import app_env, free_port, GUILD_ID, percentile, uvicorn_process
+
+
+RESULTS_PATH = Path('.benchmarks')
+
+SOURCE_USER_ID = 1
+
+
+# region Scenarios
+class BenchRequest(NamedTuple):
+    path: str
+    params: Dict[str, str]
+    headers: Dict[str, str]
+
+
+def nightbot_headers(user_id: int) -> Dict[str, str]:
+    return {
+        'Nightbot-Response-Url': f'https://api.nightbot.tv/1/channel/send/{user_id}',
+        'Nightbot-User': (
+            f'name=user{user_id}&displayName=User{user_id}&provider=discord&providerId={user_id}&userLevel=everyone'
+        ),
+        'Nightbot-Channel': f'name=channel&displayName=Channel&provider=discord&providerId={GUILD_ID}',
+    }
+
+
+def fight_request(n: int) -> BenchRequest:
+    return BenchRequest('/fight/', {'message': f'<@!{1000 + n}>'}, nightbot_headers(SOURCE_USER_ID))
+
+
+def urban_request(n: int) -> BenchRequest:
+    return BenchRequest('/urban/', {'term': f'term{n}'}, nightbot_headers(SOURCE_USER_ID))
+
+
+SCENARIOS: Dict[str, Callable[[int], BenchRequest]] = {
+    'fight': fight_request,
+    'urban': urban_request,
+}
+# endregion
+
+
+# region Load generation
+async def run_load(client: httpx.AsyncClient, requests: List[BenchRequest], concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    queue = iter(requests)
+
+    async def worker() -> None:
+        nonlocal errors
+        for request in queue:
+            start = perf_counter()
+            try:
+                response = await client.get(request.path, params=request.params, headers=request.headers)
+                if response.status_code != httpx.codes.OK or 'error' in response.text.lower():
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+async def run_benchmarks(base_url: str, args: Namespace) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        # Unique keys per run and scenario, so that cold runs never hit a cache warmed by an earlier one
+        offset = 0
+
+        for name, make_request in SCENARIOS.items():
+            if args.scenario and name not in args.scenario:
+                continue
+
+            cold = [make_request(offset + n) for n in range(args.requests)]
+            offset += args.requests
+            results[f'{name}/cold'] = await run_load(client, cold, args.concurrency)
+
+            hot_keys = [make_request(offset + n) for n in range(args.warm_keys)]
+            offset += args.warm_keys
+            await run_load(client, hot_keys, args.concurrency)
+            warm = [hot_keys[n % len(hot_keys)] for n in range(args.requests)]
+            results[f'{name}/warm'] = await run_load(client, warm, args.concurrency)
+
+    return results
+# endregion
+
+
+# region Reporting
+def git_commit() -> str:
+    try:
+        return subprocess.run(  # noqa: S603,S607
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def latest_results() -> Optional[Path]:
+    paths = sorted(RESULTS_PATH.glob('*.json'))
+    return paths[-1] if paths else None
+
+
+def print_results(results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Dict[str, Any]]]) -> None:
+    columns: List[Tuple[str, str]] = [('rps', 'req/s'), ('p50_ms', 'p50 ms'), ('p99_ms', 'p99 ms')]
+
+    header = f'{"scenario":<14}' + ''.join(f'{title:>18}' for _, title in columns) + f'{"errors":>8}'
+    print(header)
+    print('-' * len(header))
+
+    for scenario, result in results.items():
+        line = f'{scenario:<14}'
+        for key, _ in columns:
+            cell = f'{result[key]:.1f}'
+            if baseline and scenario in baseline and baseline[scenario][key]:
+                change = result[key] / baseline[scenario][key] - 1
+                cell += f' ({change:+.0%})'
+            line += f'{cell:>18}'
+        print(line + f'{result["errors"]:>8}')
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='requests per run')
+    parser.add_argument('--concurrency', type=int, default=20, help='requests in flight at once')
+    parser.add_argument('--warm-keys', type=int, default=10, help='distinct keys requested in warm runs')
+    parser.add_argument('--latency', type=float, default=0.05, help='upstream latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='upstream latency jitter, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream requests failing')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='only run these scenarios')
+    parser.add_argument('--compare', type=Path, help='results to compare with, defaults to the latest saved')
+    parser.add_argument('--no-save', action='store_true', help="don't save results")
+    parser.add_argument('--verbose', action='store_true', help='show output of the app and upstream processes')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    stub_env = {
+        'BENCH_STUB_LATENCY': str(args.latency),
+        'BENCH_STUB_JITTER': str(args.jitter),
+        'BENCH_STUB_ERROR_RATE': str(args.error_rate),
+    }
+
+    with uvicorn_process('benchmarks.stubs:create_app', free_port(), stub_env, args.verbose) as stub_url:
+        with uvicorn_process('benchmarks.app:create_app', free_port(), app_env(stub_url), args.verbose) as app_url:
+            results = asyncio.run(run_benchmarks(app_url, args))
+
+    output: Dict[str, Any] = {
+        'commit': git_commit(),
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'arguments': {key: value for key, value in vars(args).items() if key not in ('compare', 'no_save', 'verbose')},
+        'results': results,
+    }
+
+    baseline_path = args.compare or latest_results()
+    baseline = json.loads(baseline_path.read_text())['results'] if baseline_path else None
+    if baseline_path:
+        print(f'Compared with {baseline_path}')
+
+    print_results(results, baseline)
+
+    if not args.no_save:
+        RESULTS_PATH.mkdir(exist_ok=True)
+        path = RESULTS_PATH / f'{output["time"].replace(":", "")}-{output["commit"]}.json'
+        path.write_text(json.dumps(output, indent=2))
+        print(f'Saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
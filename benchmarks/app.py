@@ -0,0 +1,15 @@
+"""The `nb4mna` app, pointed at local upstream stand-ins given in `BENCH_TATSUMAKI_URL` and `BENCH_URBAN_URL`"""
+
+import os
+
+from fastapi import FastAPI
+import nb4mna
+from nb4mna.api.tatsumaki import TatsumakiAPI
+from nb4mna.api.urbandictionary import UrbanDictionaryAPI
+
+
+def create_app() -> FastAPI:
+    TatsumakiAPI.API_ENDPOINT = os.environ['BENCH_TATSUMAKI_URL']
+    UrbanDictionaryAPI.API_ENDPOINT = os.environ['BENCH_URBAN_URL']
+
+    return nb4mna.app
@@ -0,0 +1,71 @@
+"""Running the app and the upstream stand-ins in their own processes, and summarizing latencies"""
+
+from contextlib import contextmanager
+import json
+import os
+import socket
+import subprocess  # noqa: S404
+import sys
+from time import sleep
+from typing import Dict, Iterator, List
+
+
+GUILD_ID = 1
+
+
+# region Processes
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return int(s.getsockname()[1])
+
+
+@contextmanager
+def uvicorn_process(factory: str, port: int, env: Dict[str, str], verbose: bool) -> Iterator[str]:
+    """Runs an app factory in a uvicorn process, yields its base URL once it accepts connections"""
+    process = subprocess.Popen(  # noqa: S603
+        [sys.executable, '-m', 'uvicorn', '--factory', factory, '--port', str(port), '--log-level', 'warning'],
+        env={**os.environ, **env},
+        stdout=None if verbose else subprocess.DEVNULL,
+        stderr=None if verbose else subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+
+    try:
+        for _ in range(200):
+            if process.poll() is not None:
+                raise RuntimeError(f'{factory} exited with code {process.returncode}')
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                    break
+            except OSError:
+                sleep(0.05)
+        else:
+            raise RuntimeError(f'{factory} did not start listening on port {port}')
+
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def app_env(stub_url: str) -> Dict[str, str]:
+    """Environment of `benchmarks.app`, pointed at the upstream stand-ins at `stub_url`"""
+    return {
+        'BENCH_TATSUMAKI_URL': f'{stub_url}/v1',
+        'BENCH_URBAN_URL': f'{stub_url}/v0',
+        'TATSUMAKI__API_KEY': 'benchmark',
+        'TATSUMAKI__GUILD_ID': str(GUILD_ID),
+        # Don't let the real Tatsumaki rate limit throttle the stand-in
+        'TATSUMAKI__UPSTREAM__RATE_LIMIT': '1000000',
+        # Let deferred replies, if enabled, go to the stand-in of Nightbot
+        'DEFERRED_REPLIES__RESPONSE_URL_ORIGINS': json.dumps([stub_url]),
+    }
+# endregion
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
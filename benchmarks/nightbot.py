@@ -0,0 +1,77 @@
+"""
+Benchmarks decoding of the Nightbot headers, parsed anew on every request versus memoized per header value
+
+Requests come from a fixed number of chatters, so that after the first round memoized headers are all cache hits.
+
+    python -m benchmarks.nightbot --chatters 300 --requests 100000
+"""
+
+from argparse import ArgumentParser, Namespace
+import os
+from time import perf_counter
+from typing import Callable, List, Tuple
+
+from pydantic import HttpUrl, TypeAdapter
+
+
+Headers = Tuple[HttpUrl, str, str]
+Decoder = Callable[[HttpUrl, str, str], object]
+
+
+def make_headers(chatters: int) -> List[Headers]:
+    # FastAPI validates the response URL before it gets to the dependency
+    response_url = TypeAdapter(HttpUrl).validate_python('https://api.nightbot.tv/1/channel/send/abc')
+    channel = 'name=channel&displayName=Channel&provider=discord&providerId=1'
+
+    return [
+        (
+            response_url,
+            f'name=user{n}&displayName=User{n}&provider=discord&providerId={n}&userLevel=everyone',
+            channel,
+        )
+        for n in range(chatters)
+    ]
+
+
+def run(decode: Decoder, headers: List[Headers], requests: int) -> float:
+    """Microseconds per request"""
+    start = perf_counter()
+    for i in range(requests):
+        decode(*headers[i % len(headers)])
+    return (perf_counter() - start) / requests * 1e6
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog='python -m benchmarks.nightbot', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chatters', type=int, default=300, help='distinct users sending commands')
+    parser.add_argument('--requests', type=int, default=100_000, help='requests per run')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    headers = make_headers(args.chatters)
+
+    # Importing the app requires its settings, which don't matter here
+    os.environ.setdefault('TATSUMAKI__API_KEY', 'benchmark')
+    os.environ.setdefault('TATSUMAKI__GUILD_ID', '1')
+    os.environ.setdefault('LOGGING__LEVEL', 'WARNING')
+    from nb4mna.api.nightbot import _dependency, NightbotChannel, NightbotData, NightbotUser, url_decode
+
+    def decode_uncached(response_url: HttpUrl, user: str, channel: str) -> NightbotData:
+        """Decoding as it was before memoization"""
+        return NightbotData(
+            response_url=response_url,
+            user=url_decode(NightbotUser, user),
+            channel=url_decode(NightbotChannel, channel),
+        )
+
+    uncached = run(decode_uncached, headers, args.requests)
+    memoized = run(_dependency, headers, args.requests)
+
+    print(f'{"uncached":<10}{uncached:>10.2f} µs/request')
+    print(f'{"memoized":<10}{memoized:>10.2f} µs/request ({memoized / uncached - 1:+.0%})')
+
+
+if __name__ == '__main__':
+    main()
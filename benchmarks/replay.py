@@ -0,0 +1,206 @@
+"""
+Replays commands captured by the app against local stand-ins for the upstream APIs
+
+Commands are sent at the times they arrived at, sped up by `--speed`, however long earlier ones take,
+so that bursts are as bursty as they were. Reports latency percentiles per path, and hit ratios of the app's caches.
+Settings to try out are passed to the app through the environment, as usual:
+
+    URBAN__CACHE__DURATION=60 python -m benchmarks.replay capture.jsonl --speed 10
+"""
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+import json
+from pathlib import Path
+import re
+from time import perf_counter
+from typing import Any, Dict, List, NamedTuple, Set, Tuple
+from urllib.parse import urlencode
+
+import httpx
+
+from .harness import app_env, free_port, percentile, uvicorn_process
+
+
+CACHE_METRIC_REGEX = re.compile(r'^nb4mna_cache_(hits|misses)_total\{cache="([^"]*)"} (\S+)$', re.MULTILINE)
+
+
+class CapturedRequest(NamedTuple):
+    time: float
+    path: str
+    params: Dict[str, str]
+    user: Dict[str, str]
+    channel: Dict[str, str]
+
+
+def load_capture(path: Path, limit: int) -> List[CapturedRequest]:
+    requests: List[CapturedRequest] = []
+    with path.open(encoding='utf-8') as f:
+        for line in f:
+            if limit and len(requests) >= limit:
+                break
+            record = json.loads(line)
+            requests.append(
+                CapturedRequest(record['t'], record['p'], record['q'], record.get('u', {}), record.get('c', {}))
+            )
+
+    # Lines of several processes may be slightly out of order
+    return sorted(requests, key=lambda request: request.time)
+
+
+def replay_headers(request: CapturedRequest, response_url: str) -> Dict[str, str]:
+    headers = {'Nightbot-Response-Url': response_url}
+    if request.user:
+        headers['Nightbot-User'] = urlencode(request.user)
+    if request.channel:
+        headers['Nightbot-Channel'] = urlencode(request.channel)
+    return headers
+
+
+async def replay(
+    client: httpx.AsyncClient, requests: List[CapturedRequest], speed: float, response_url: str
+) -> Tuple[Dict[str, List[float]], Dict[str, int]]:
+    """Latencies and number of errors per path"""
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    tasks: Set[asyncio.Task[None]] = set()
+
+    async def send(request: CapturedRequest) -> None:
+        start = perf_counter()
+        try:
+            response = await client.get(
+                request.path, params=request.params, headers=replay_headers(request, response_url)
+            )
+            failed = response.status_code != httpx.codes.OK or 'error' in response.text.lower()
+        except httpx.HTTPError:
+            failed = True
+
+        latencies.setdefault(request.path, []).append(perf_counter() - start)
+        errors[request.path] = errors.get(request.path, 0) + failed
+
+    start = perf_counter()
+    for request in requests:
+        delay = (request.time - requests[0].time) / speed - (perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        task = asyncio.create_task(send(request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks)
+    return latencies, errors
+
+
+async def get_cache_stats(client: httpx.AsyncClient) -> Dict[str, Dict[str, float]]:
+    """Hits and misses per cache"""
+    response = await client.get('/metrics')
+    response.raise_for_status()
+
+    stats: Dict[str, Dict[str, float]] = {}
+    for kind, cache, value in CACHE_METRIC_REGEX.findall(response.text):
+        stats.setdefault(cache, {'hits': 0.0, 'misses': 0.0})[kind] = float(value)
+    return stats
+
+
+async def run_replay(base_url: str, response_url: str, args: Namespace) -> Dict[str, Any]:
+    requests = load_capture(args.capture, args.limit)
+    if not requests:
+        raise SystemExit(f'No requests in {args.capture}')
+
+    async with httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=None), timeout=60.0) as client:
+        before = await get_cache_stats(client)
+        start = perf_counter()
+        latencies, errors = await replay(client, requests, args.speed, response_url)
+        elapsed = perf_counter() - start
+        after = await get_cache_stats(client)
+
+    paths = {}
+    for path, path_latencies in sorted(latencies.items()):
+        path_latencies.sort()
+        paths[path] = {
+            'requests': len(path_latencies),
+            'errors': errors[path],
+            'p50_ms': percentile(path_latencies, 0.50) * 1000,
+            'p90_ms': percentile(path_latencies, 0.90) * 1000,
+            'p99_ms': percentile(path_latencies, 0.99) * 1000,
+            'max_ms': path_latencies[-1] * 1000,
+        }
+
+    caches = {}
+    for cache, stats in after.items():
+        hits = stats['hits'] - before.get(cache, {}).get('hits', 0.0)
+        misses = stats['misses'] - before.get(cache, {}).get('misses', 0.0)
+        if hits or misses:
+            caches[cache] = {'hits': hits, 'misses': misses, 'hit_ratio': hits / (hits + misses)}
+
+    return {
+        'requests': len(requests),
+        'captured_seconds': requests[-1].time - requests[0].time,
+        'replayed_seconds': elapsed,
+        'paths': paths,
+        'caches': caches,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(
+        f'Replayed {report["requests"]} requests captured over {report["captured_seconds"]:.1f} seconds'
+        f' in {report["replayed_seconds"]:.1f} seconds'
+    )
+    print()
+
+    header = f'{"path":<14}{"requests":>10}{"errors":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}'
+    print(header)
+    print('-' * len(header))
+    for path, result in report['paths'].items():
+        percentiles = ''.join(f'{result[key]:>10.1f}' for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        print(f'{path:<14}{result["requests"]:>10}{result["errors"]:>8}{percentiles}')
+    print()
+
+    header = f'{"cache":<28}{"hits":>10}{"misses":>10}{"hit ratio":>12}'
+    print(header)
+    print('-' * len(header))
+    for cache, stats in sorted(report['caches'].items()):
+        print(f'{cache:<28}{stats["hits"]:>10.0f}{stats["misses"]:>10.0f}{stats["hit_ratio"]:>12.1%}')
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog='python -m benchmarks.replay', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('capture', type=Path, help='file captured with CAPTURE__PATH')
+    parser.add_argument('--speed', type=float, default=1.0, help='how many times faster than captured to replay')
+    parser.add_argument('--limit', type=int, default=0, help='replay only this many requests')
+    parser.add_argument('--latency', type=float, default=0.05, help='upstream latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='upstream latency jitter, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream requests failing')
+    parser.add_argument('--json', type=Path, help='also save the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show output of the app and upstream processes')
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+
+    stub_env = {
+        'BENCH_STUB_LATENCY': str(args.latency),
+        'BENCH_STUB_JITTER': str(args.jitter),
+        'BENCH_STUB_ERROR_RATE': str(args.error_rate),
+    }
+
+    with uvicorn_process('benchmarks.stubs:create_app', free_port(), stub_env, args.verbose) as stub_url:
+        with uvicorn_process('benchmarks.app:create_app', free_port(), app_env(stub_url), args.verbose) as app_url:
+            report = asyncio.run(run_replay(app_url, f'{stub_url}/nightbot/send', args))
+
+    print_report(report)
+
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+        print(f'Saved to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
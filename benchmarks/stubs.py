@@ -0,0 +1,88 @@
+"""
+Local stand-ins for the Tatsumaki and Urban Dictionary APIs, and for Nightbot's response URLs
+
+Responses are shaped like the real ones, with latency and error rate configured through environment variables:
+`BENCH_STUB_LATENCY` and `BENCH_STUB_JITTER` (seconds), `BENCH_STUB_ERROR_RATE` (0 to 1).
+"""
+
+import asyncio
+import os
+from random import random, uniform
+from typing import Any, Dict, List
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+
+RANKINGS_PAGE_SIZE = 100
+GUILD_MEMBERS = 1000
+
+
+def create_app() -> FastAPI:
+    latency = float(os.environ.get('BENCH_STUB_LATENCY', '0.05'))
+    jitter = float(os.environ.get('BENCH_STUB_JITTER', '0.0'))
+    error_rate = float(os.environ.get('BENCH_STUB_ERROR_RATE', '0.0'))
+
+    app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+
+    async def upstream_delay() -> bool:
+        """Waits like the upstream would, returns whether the request should fail"""
+        await asyncio.sleep(max(0.0, latency + uniform(-jitter, jitter)))
+        return random() < error_rate
+
+    def member_ranking(guild_id: int, user_id: int) -> Dict[str, Any]:
+        rank = user_id % GUILD_MEMBERS + 1
+        return {
+            'guild_id': str(guild_id),
+            'rank': rank,
+            'score': (GUILD_MEMBERS - rank + 1) * 100,
+            'user_id': str(user_id),
+        }
+
+    @app.get('/health')
+    async def health() -> Dict[str, str]:
+        return {'status': 'ok'}
+
+    @app.post('/nightbot/send')
+    async def nightbot_send() -> Dict[str, int]:
+        return {'status': 200}
+
+    @app.get('/v1/guilds/{guild_id}/rankings/members/{user_id}/all', response_model=None)
+    async def tatsumaki_member_ranking(guild_id: int, user_id: int) -> Dict[str, Any] | JSONResponse:
+        if await upstream_delay():
+            return JSONResponse({'code': 500, 'message': 'Internal Server Error'}, status_code=500)
+        return member_ranking(guild_id, user_id)
+
+    @app.get('/v1/guilds/{guild_id}/rankings/all', response_model=None)
+    async def tatsumaki_rankings(guild_id: int, offset: int = 0) -> Dict[str, Any] | JSONResponse:
+        if await upstream_delay():
+            return JSONResponse({'code': 500, 'message': 'Internal Server Error'}, status_code=500)
+        rankings = [
+            {key: value for key, value in member_ranking(guild_id, user_id).items() if key != 'guild_id'}
+            for user_id in range(offset, min(offset + RANKINGS_PAGE_SIZE, GUILD_MEMBERS))
+        ]
+        return {'guild_id': str(guild_id), 'rankings': rankings}
+
+    @app.get('/v0/autocomplete', response_model=None)
+    async def urbandictionary_autocomplete(term: str) -> List[str] | JSONResponse:
+        if await upstream_delay():
+            return JSONResponse({'error': 'Internal Server Error'}, status_code=500)
+        return [f'{term}s', term.upper(), f'{term} {term}']
+
+    @app.get('/v0/define', response_model=None)
+    async def urbandictionary_define(term: str) -> Dict[str, Any] | JSONResponse:
+        if await upstream_delay():
+            return JSONResponse({'error': 'Internal Server Error'}, status_code=500)
+        definition = f'A [placeholder] definition of {term}.\r\n' + 'Lorem ipsum dolor sit amet. ' * 20
+        return {
+            'list': [
+                {
+                    'definition': definition,
+                    'permalink': f'http://{term.replace(" ", "-")}.urbanup.com/{n}',
+                    'word': term,
+                }
+                for n in range(10)
+            ]
+        }
+
+    return app
@@ -8,11 +8,11 @@ import nox_poetry
 
 
 # Default list of files to check
-locations = ['src', './noxfile.py']
+locations = ['src', 'benchmarks', 'tests', './noxfile.py']
 # List of supported Python versions (ordered newest to oldest)
 supported_python_versions = ['3.13', '3.12']
 
-nox.options.sessions = ('flake8', 'mypy', 'safety')
+nox.options.sessions = ('flake8', 'mypy', 'tests', 'safety')
 
 
 class TemporaryFileProtocol(Protocol):
@@ -56,6 +56,18 @@ def mypy(session: nox.Session) -> None:
     session.run('mypy', *args)
 
 
+@nox_poetry.session(python=supported_python_versions)
+def tests(session: nox.Session) -> None:
+    session.install('.')
+    session.run('python', '-m', 'unittest', 'discover', '-s', 'tests', '-t', '.', *session.posargs)
+
+
+@nox_poetry.session(python=supported_python_versions[0])
+def bench(session: nox.Session) -> None:
+    session.install('.')
+    session.run('python', '-m', 'benchmarks', *session.posargs)
+
+
 @nox_poetry.session(python=supported_python_versions[0])
 def safety(session: nox.Session) -> None:
     session.install('safety')
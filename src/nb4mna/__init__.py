@@ -5,12 +5,41 @@ from .logging import configure_logging
 
 configure_logging()
 
-from typing import Dict
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from typing import AsyncIterator, Dict
 
 from asgi_correlation_id import CorrelationIdMiddleware
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
+from . import capture, diagnostics, throttling
+from .clients import clients
+from .metrics import registry, RequestDurationMiddleware
 from .modules import fight, urban
+from .phases import PhaseTimingMiddleware
+from .replies import deferred_replies
+from .settings import settings
+
+
+configure_logging(settings.logging)
+
+_logger = logging.getLogger('nb4mna')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    async with clients:
+        try:
+            await asyncio.wait_for(asyncio.gather(fight.warm_up(), urban.warm_up()), timeout=settings.warmup.timeout)
+        except TimeoutError:
+            _logger.warning('Warm-up did not finish in %.0f seconds, serving requests anyway', settings.warmup.timeout)
+
+        yield
+
+        # Deferred replies may still need the other clients, which are closed right after
+        await deferred_replies.get().drain()
 
 
 app = FastAPI(
@@ -20,7 +49,11 @@ app = FastAPI(
     openapi_url=None,
     docs_url=None,
     redoc_url=None,
+    lifespan=lifespan,
 )
+if settings.diagnostics.phase_timings:
+    app.add_middleware(PhaseTimingMiddleware)
+app.add_middleware(RequestDurationMiddleware)
 app.add_middleware(CorrelationIdMiddleware)
 
 
@@ -29,5 +62,13 @@ def healthcheck() -> Dict[str, str]:
     return {'status': 'ok'}
 
 
+@app.get('/metrics')
+def metrics() -> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
+capture.install(app, settings.capture)
+diagnostics.install(app, settings.diagnostics)
+throttling.install(app, settings.throttling)
 fight.install(app)
 urban.install(app)
@@ -0,0 +1,93 @@
+"""
+Command line interface
+
+    python -m nb4mna serve --workers 4
+
+`serve` runs the app in pre-forked worker processes sharing the listening socket passed in on file descriptor 3
+by systemd socket activation. uvloop and httptools are used if they're installed.
+"""
+
+from argparse import ArgumentParser, Namespace
+import os
+from pathlib import Path
+import socket
+import sys
+
+from . import app
+from .runner import Supervisor
+
+
+def serve(args: Namespace) -> int:
+    sock = socket.socket(fileno=args.fd)
+
+    supervisor = Supervisor(
+        sock,
+        config={
+            'app': app,
+            'loop': args.loop,
+            'http': args.http,
+            'server_header': False,
+            'limit_max_requests': args.max_requests,
+            'timeout_graceful_shutdown': round(args.graceful_timeout),
+            # Logging is already configured by the app
+            'log_config': None,
+        },
+        workers=args.workers,
+        max_worker_age=args.max_worker_age,
+        heartbeat_interval=args.heartbeat_interval,
+        heartbeat_timeout=args.heartbeat_timeout,
+        startup_timeout=args.startup_timeout,
+        graceful_timeout=args.graceful_timeout,
+        health_path=args.health_file,
+    )
+    return supervisor.run()
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog='nb4mna', description='Custom Nightbot APIs for MedicNinjaa')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='serve the app from pre-forked workers')
+    serve_parser.set_defaults(function=serve)
+    serve_parser.add_argument('--fd', type=int, default=3, help='file descriptor of the listening socket')
+    serve_parser.add_argument(
+        '--workers',
+        type=int,
+        default=int(os.environ.get('NB4MNA_WORKERS', 1)),
+        help='worker processes, defaults to $NB4MNA_WORKERS or 1; upstream rate limits apply to each one',
+    )
+    serve_parser.add_argument('--loop', choices=['auto', 'asyncio', 'uvloop'], default='auto', help='event loop')
+    serve_parser.add_argument('--http', choices=['auto', 'h11', 'httptools'], default='auto', help='HTTP parser')
+    serve_parser.add_argument('--max-requests', type=int, help='recycle workers after this many requests')
+    serve_parser.add_argument('--max-worker-age', type=float, help='recycle workers after this many seconds')
+    serve_parser.add_argument('--heartbeat-interval', type=float, default=1.0, help='seconds between heartbeats')
+    serve_parser.add_argument(
+        '--heartbeat-timeout',
+        type=float,
+        default=30.0,
+        help='kill workers missing heartbeats for this many seconds',
+    )
+    serve_parser.add_argument(
+        '--startup-timeout',
+        type=float,
+        default=60.0,
+        help='kill workers not ready after this many seconds',
+    )
+    serve_parser.add_argument(
+        '--graceful-timeout',
+        type=float,
+        default=30.0,
+        help='kill workers not stopped this many seconds after being asked to',
+    )
+    serve_parser.add_argument('--health-file', type=Path, help='keep worker health in this JSON file')
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    sys.exit(args.function(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+from abc import ABC, abstractmethod
+import asyncio
+from contextvars import Context
+import logging
+from typing import Any, Dict, NoReturn, Optional
+
+import httpx
+
+from ..deadlines import DeadlineExceededException, within_deadline
+from ..scheduling import UpstreamUnavailableException
+
+
+class BaseAPI(ABC):
+    """Requests and connection upkeep shared by clients of upstream APIs"""
+
+    API_ENDPOINT: str
+
+    def __init__(self, client: httpx.AsyncClient, logger: logging.Logger, headers: Optional[Dict[str, str]] = None):
+        self._logger = logger
+
+        self.client = client
+        self.headers = headers or {}
+
+        self.connection_keepalive_task: Optional[asyncio.Task[None]] = None
+
+    @abstractmethod
+    def _unavailable(self, message: str) -> NoReturn:
+        """Raises the API's own exception for a request that couldn't be made, or not in time"""
+
+    async def _get(self, url: str, endpoint: str, **kwargs: Any) -> httpx.Response:
+        try:
+            return await within_deadline(
+                self.client.get(url, headers=self.headers, extensions={'nb4mna.endpoint': endpoint}, **kwargs)
+            )
+        except (UpstreamUnavailableException, DeadlineExceededException) as e:
+            self._unavailable(str(e))
+
+    async def prewarm(self) -> None:
+        """Opens a connection to the API, so that the first actual request doesn't have to"""
+        try:
+            # Bypasses the cache and upstream scheduler, pings shouldn't use up the rate limit
+            await self.client.head(
+                self.API_ENDPOINT, headers=self.headers, extensions={'nb4mna.endpoint': 'prewarm', 'nb4mna.ping': True}
+            )
+        except httpx.HTTPError as e:
+            self._logger.warning('Failed to open connection: %r', e)
+
+    async def keep_connection_alive_task(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.prewarm()
+
+    def keep_connection_alive(self, interval: float) -> None:
+        """Keeps the connection to the API from going idle, by pinging it every `interval` seconds"""
+        if self.connection_keepalive_task is None:
+            self.connection_keepalive_task = asyncio.create_task(
+                self.keep_connection_alive_task(interval), context=Context()
+            )
+
+    async def stop(self) -> None:
+        """Stops background tasks, leaving the HTTP client open for others sharing it"""
+        if self.connection_keepalive_task is not None:
+            self.connection_keepalive_task.cancel()
+            await asyncio.gather(self.connection_keepalive_task, return_exceptions=True)
+
+    async def aclose(self) -> None:
+        await self.stop()
+        await self.client.aclose()
@@ -1,16 +1,25 @@
 import logging
-from typing import Type, TypeVar
+from typing import Optional, Type, TypeVar
 from urllib.parse import parse_qs
 
 from fastapi import Depends, Header
-from pydantic import BaseModel, HttpUrl
+import httpx
+from pydantic import BaseModel, ConfigDict, HttpUrl, TypeAdapter
+
+from ..caching import ResultCache
+from ..phases import phase
 
 
 MAX_MESSAGE_LENGTH = 400
 
+# Distinct `Nightbot-User` and `Nightbot-Channel` header values to keep parsed, per header
+MAX_CACHED_HEADERS = 4096
+
 
 _logger = logging.getLogger('nb4mna.api.nightbot')
 
+_http_url: TypeAdapter[HttpUrl] = TypeAdapter(HttpUrl)
+
 
 # region Data models
 ModelT = TypeVar('ModelT')
@@ -23,6 +32,8 @@ def url_decode(model: Type[ModelT], url_encoded: str) -> ModelT:
 
 
 class NightbotUser(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str
     displayName: str
     provider: str
@@ -31,6 +42,8 @@ class NightbotUser(BaseModel):
 
 
 class NightbotChannel(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str
     displayName: str
     provider: str
@@ -44,19 +57,84 @@ class NightbotData(BaseModel):
 # endregion
 
 
+# The same chatters send the same header values over and over, which are only parsed once
+_user_cache: ResultCache[str, NightbotUser] = ResultCache(
+    duration=float('inf'),
+    max_entries=MAX_CACHED_HEADERS,
+    name='nightbot.user',
+)
+_channel_cache: ResultCache[str, NightbotChannel] = ResultCache(
+    duration=float('inf'),
+    max_entries=MAX_CACHED_HEADERS,
+    name='nightbot.channel',
+)
+
+
+def url_decode_cached(cache: ResultCache[str, ModelT], model: Type[ModelT], url_encoded: str) -> ModelT:
+    """`url_decode()` of an immutable model, memoized per URL encoded value"""
+    value = cache.get(url_encoded)
+    if value is None:
+        value = url_decode(model, url_encoded)
+        cache.put(url_encoded, value)
+    return value
+
+
 def _dependency(
     nightbot_response_url: HttpUrl = Header(None),  # noqa: B008
     nightbot_user: str = Header(None),  # noqa: B008
     nightbot_channel: str = Header(None),  # noqa: B008
 ) -> NightbotData:
 
-    _logger.debug(f'{nightbot_user=}\n{nightbot_channel=}')
+    _logger.debug('nightbot_user=%r\nnightbot_channel=%r', nightbot_user, nightbot_channel)
+
+    with phase('headers'):
+        user = url_decode_cached(_user_cache, NightbotUser, nightbot_user)
+        channel = url_decode_cached(_channel_cache, NightbotChannel, nightbot_channel)
+
+    if nightbot_response_url is None:
+        # Fails validation, just like any other header missing
+        return NightbotData(response_url=nightbot_response_url, user=user, channel=channel)
 
-    return NightbotData(
-        response_url=nightbot_response_url,
-        user=url_decode(NightbotUser, nightbot_user),
-        channel=url_decode(NightbotChannel, nightbot_channel),
-    )
+    # Every field is validated already, the response URL by FastAPI
+    return NightbotData.model_construct(response_url=nightbot_response_url, user=user, channel=channel)
+
+
+def _optional_dependency(
+    nightbot_response_url: Optional[str] = Header(None),  # noqa: B008
+    nightbot_user: Optional[str] = Header(None),  # noqa: B008
+    nightbot_channel: Optional[str] = Header(None),  # noqa: B008
+) -> Optional[NightbotData]:
+    """
+    Nightbot data for requests made by Nightbot, None for requests made by anything else
+
+    Requests with headers that don't parse are treated as not made by Nightbot, rather than failing.
+    """
+    if nightbot_response_url is None or nightbot_user is None or nightbot_channel is None:
+        return None
+
+    try:
+        response_url = _http_url.validate_python(nightbot_response_url)
+        return _dependency(response_url, nightbot_user, nightbot_channel)
+    except (TypeError, ValueError) as e:
+        _logger.debug('Ignoring invalid Nightbot headers: %r', e)
+        return None
 
 
 NightbotDepends = Depends(_dependency)
+NightbotOptionalDepends = Depends(_optional_dependency)
+
+
+class NightbotAPI:
+    """Sends messages to chat through the response URLs Nightbot passes along with commands"""
+
+    def __init__(self, client: httpx.AsyncClient) -> None:
+        self._logger = logging.getLogger('nb4mna.api.nightbot')
+
+        self.client = client
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def send_message(self, response_url: HttpUrl, message: str) -> None:
+        response = await self.client.post(str(response_url), json={'message': message[:MAX_MESSAGE_LENGTH]})
+        response.raise_for_status()
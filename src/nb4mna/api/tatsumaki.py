@@ -1,10 +1,16 @@
+import asyncio
+from contextvars import Context
 from dataclasses import dataclass
 import logging
+from time import time
+from typing import Dict, NamedTuple, NoReturn, Optional, Sequence, Tuple
 
 import httpx
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
-from ..caching import AsyncCachedHTTPTransport
+from .base import BaseAPI
+from ..caching import get_response_age, get_response_freshness, ResultCache
+from ..phases import phase
 
 
 # region Data models
@@ -14,10 +20,32 @@ class TatsumakiAPIError(BaseModel):
 
 
 class MemberRanking(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     guild_id: int
     rank: int
     score: int
     user_id: int
+
+
+class GuildRanking(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    rank: int
+    score: int
+    user_id: int
+
+
+class GuildRankings(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    guild_id: int
+    rankings: Tuple[GuildRanking, ...]
+
+
+class Leaderboard(NamedTuple):
+    members: Dict[int, MemberRanking]
+    time: float
 # endregion
 
 
@@ -31,38 +59,143 @@ class TatsumakiAPIException(Exception):
 # endregion
 
 
-class TatsumakiAPI:
+class TatsumakiAPI(BaseAPI):
     API_ENDPOINT = 'https://api.tatsu.gg/v1'
+    CACHE_DURATION = 60.0
+    RANKINGS_PAGE_SIZE = 100
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        api_key: str,
+        guild_id: int,
+        cache_duration: float = CACHE_DURATION,
+        leaderboard_refresh_interval: Optional[float] = None,
+        leaderboard_max_pages: int = 50,
+        member_ranking_cache: Optional[ResultCache[Tuple[int, int], MemberRanking]] = None,
+    ) -> None:
+        super().__init__(
+            client, logging.getLogger(f'nb4mna.api.tatsumaki.{guild_id}'), headers={'Authorization': api_key}
+        )
 
-    def __init__(self, api_key: str, guild_id: int) -> None:
-        self._logger = logging.getLogger(f'nb4mna.api.tatsumaki.{guild_id}')
+        self.guild_id = guild_id
 
-        self.client = httpx.AsyncClient(
-            http2=True,
-            transport=AsyncCachedHTTPTransport(
-                http2=True,
-                cache_duration=60.0,
-            ),
+        # Keyed by guild and user ID, so that it may be shared with clients of other guilds
+        self.member_ranking_cache: ResultCache[Tuple[int, int], MemberRanking] = (
+            member_ranking_cache
+            if member_ranking_cache is not None
+            else ResultCache(duration=cache_duration, name='tatsumaki.member_ranking')
         )
-        self.client.headers['Authorization'] = api_key
 
-        self.guild_id = guild_id
+        # Whole guild leaderboard, periodically fetched in bulk to serve member rankings from, if enabled
+        self.leaderboard: Optional[Leaderboard] = None
+        self.leaderboard_refresh_interval = leaderboard_refresh_interval
+        self.leaderboard_max_pages = leaderboard_max_pages
+        self.leaderboard_refresh_task: Optional[asyncio.Task[None]] = None
+
+        if leaderboard_refresh_interval is not None:
+            # Clients may be created while handling a request, whose deadline and timings the task shouldn't inherit
+            self.leaderboard_refresh_task = asyncio.create_task(self.refresh_leaderboard_task(), context=Context())
 
     def __hash__(self) -> int:
         return hash(self.guild_id)
 
-    def _error(self, api_error: TatsumakiAPIError) -> None:
+    def _error(self, api_error: TatsumakiAPIError) -> NoReturn:
         self._logger.error(f'{api_error=}', stacklevel=2)
         raise TatsumakiAPIException(api_error=api_error)
 
-    async def get_guild_member_ranking(self, user_id: int) -> MemberRanking:
-        api_result = await self.client.get(f'{self.API_ENDPOINT}/guilds/{self.guild_id}/rankings/members/{user_id}/all')
+    def _raise_for_status(self, api_result: httpx.Response) -> None:
+        if api_result.status_code == httpx.codes.OK:
+            return
 
-        if api_result.status_code != httpx.codes.OK:
+        # Not every error comes from the API itself, proxies in front of it may answer with an HTML page instead
+        try:
             api_error = TatsumakiAPIError(**api_result.json())
+        except (TypeError, ValueError):
+            api_error = TatsumakiAPIError(code=api_result.status_code, message=api_result.reason_phrase)
+        self._error(api_error=api_error)
+
+    def _unavailable(self, message: str) -> NoReturn:
+        self._error(api_error=TatsumakiAPIError(code=-1, message=message))
+
+    async def stop(self) -> None:
+        if self.leaderboard_refresh_task is not None:
+            self.leaderboard_refresh_task.cancel()
+            await asyncio.gather(self.leaderboard_refresh_task, return_exceptions=True)
+
+        await super().stop()
+
+    async def get_guild_rankings(self, offset: int = 0) -> GuildRankings:
+        api_result = await self._get(
+            f'{self.API_ENDPOINT}/guilds/{self.guild_id}/rankings/all',
+            endpoint='rankings',
+            params={'offset': offset},
+        )
+        self._raise_for_status(api_result)
+
+        guild_rankings = GuildRankings(**api_result.json())
+
+        if guild_rankings.guild_id != self.guild_id:
+            api_error = TatsumakiAPIError(code=-1, message="Guild ID doesn't match between request and response")
             self._error(api_error=api_error)
 
-        member_ranking = MemberRanking(**api_result.json())
+        return guild_rankings
+
+    def _member_ranking(self, ranking: GuildRanking) -> MemberRanking:
+        return MemberRanking(guild_id=self.guild_id, rank=ranking.rank, score=ranking.score, user_id=ranking.user_id)
+
+    async def refresh_leaderboard(self) -> None:
+        members: Dict[int, MemberRanking] = {}
+
+        for page in range(self.leaderboard_max_pages):
+            guild_rankings = await self.get_guild_rankings(offset=page * self.RANKINGS_PAGE_SIZE)
+
+            for ranking in guild_rankings.rankings:
+                members[ranking.user_id] = self._member_ranking(ranking)
+
+            if len(guild_rankings.rankings) < self.RANKINGS_PAGE_SIZE:
+                break
+
+        self.leaderboard = Leaderboard(members=members, time=time())
+        self._logger.info(f'Refreshed leaderboard with {len(members)} members')
+
+    async def refresh_leaderboard_task(self) -> None:
+        self._logger.debug(f'Started leaderboard refresh task (every {self.leaderboard_refresh_interval:.0f} seconds)')
+
+        while self.leaderboard_refresh_interval is not None:
+            try:
+                await self.refresh_leaderboard()
+            except Exception as e:
+                # Whatever went wrong, the next refresh may well succeed, so keep the task going
+                self._logger.warning(f'Failed to refresh leaderboard: {e!r}')
+
+            await asyncio.sleep(self.leaderboard_refresh_interval)
+
+    def get_leaderboard_member_ranking(self, user_id: int) -> Optional[MemberRanking]:
+        if self.leaderboard is None or self.leaderboard_refresh_interval is None:
+            return None
+
+        # Don't keep serving a leaderboard that has missed a couple of refreshes
+        if time() - self.leaderboard.time > 2 * self.leaderboard_refresh_interval:
+            return None
+
+        return self.leaderboard.members.get(user_id, None)
+
+    async def get_guild_member_ranking(self, user_id: int) -> MemberRanking:
+        cache_key = (self.guild_id, user_id)
+        with phase('cache'):
+            member_ranking = self.get_leaderboard_member_ranking(user_id) or self.member_ranking_cache.get(cache_key)
+        if member_ranking is not None:
+            return member_ranking
+
+        api_result = await self._get(
+            f'{self.API_ENDPOINT}/guilds/{self.guild_id}/rankings/members/{user_id}/all',
+            endpoint='member_ranking',
+        )
+        self._raise_for_status(api_result)
+
+        with phase('parse'):
+            member_ranking = MemberRanking(**api_result.json())
 
         if member_ranking.guild_id != self.guild_id:
             api_error = TatsumakiAPIError(code=-1, message="Guild ID doesn't match between request and response")
@@ -73,4 +206,24 @@ class TatsumakiAPI:
             self._error(api_error=api_error)
 
         self._logger.debug(member_ranking)
+        self.member_ranking_cache.put(
+            cache_key,
+            member_ranking,
+            age=get_response_age(api_result),
+            freshness=get_response_freshness(api_result),
+        )
         return member_ranking
+
+    async def preload(self, top_members: int = 0, user_ids: Sequence[int] = ()) -> None:
+        """Caches rankings of the top `top_members` members of the guild, and of `user_ids`"""
+        for offset in range(0, top_members, self.RANKINGS_PAGE_SIZE):
+            guild_rankings = await self.get_guild_rankings(offset=offset)
+
+            for ranking in guild_rankings.rankings[: top_members - offset]:
+                self.member_ranking_cache.put((self.guild_id, ranking.user_id), self._member_ranking(ranking))
+
+            if len(guild_rankings.rankings) < self.RANKINGS_PAGE_SIZE:
+                break
+
+        await asyncio.gather(*(self.get_guild_member_ranking(user_id) for user_id in user_ids))
+        self._logger.info('Preloaded member rankings, %d cached', self.member_ranking_cache.stats.entries)
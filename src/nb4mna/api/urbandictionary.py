@@ -1,11 +1,13 @@
 from dataclasses import dataclass
 import logging
-from typing import List
+from typing import NoReturn, Optional, Tuple
 
 import httpx
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, ConfigDict, HttpUrl
 
-from ..caching import AsyncCachedHTTPTransport
+from .base import BaseAPI
+from ..caching import get_response_age, get_response_freshness, ResultCache
+from ..phases import phase
 
 
 # region Data models
@@ -14,17 +16,23 @@ class UrbanDictionaryAPIError(BaseModel):
 
 
 class AutocompletionList(BaseModel):
-    list: List[str]
+    model_config = ConfigDict(frozen=True)
+
+    list: Tuple[str, ...]
 
 
 class TermDefinition(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     definition: str
     permalink: HttpUrl
     word: str
 
 
 class TermDefinitions(BaseModel):
-    list: List[TermDefinition]
+    model_config = ConfigDict(frozen=True)
+
+    list: Tuple[TermDefinition, ...]
 # endregion
 
 
@@ -38,40 +46,87 @@ class UrbanDictionaryAPIException(Exception):
 # endregion
 
 
-class UrbanDictionaryAPI:
+class UrbanDictionaryAPI(BaseAPI):
     API_ENDPOINT = 'https://api.urbandictionary.com/v0'
-
-    def __init__(self) -> None:
-        self._logger = logging.getLogger('nb4mna.api.urbandictionary')
-
-        self.client = httpx.AsyncClient(
-            http2=True,
-            transport=AsyncCachedHTTPTransport(
-                http2=True,
-                cache_duration=600.0,
-            ),
+    CACHE_DURATION = 600.0
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        cache_duration: float = CACHE_DURATION,
+        cache_max_entries: Optional[int] = 1024,
+        cache_max_size: Optional[int] = None,
+    ) -> None:
+        super().__init__(client, logging.getLogger('nb4mna.api.urbandictionary'))
+
+        self.autocomplete_cache: ResultCache[str, AutocompletionList] = ResultCache(
+            duration=cache_duration,
+            max_entries=cache_max_entries,
+            max_size=cache_max_size,
+            name='urbandictionary.autocomplete',
+        )
+        self.term_cache: ResultCache[str, TermDefinitions] = ResultCache(
+            duration=cache_duration,
+            max_entries=cache_max_entries,
+            max_size=cache_max_size,
+            name='urbandictionary.define',
         )
 
-    def _error(self, api_error: UrbanDictionaryAPIError) -> None:
+    def _error(self, api_error: UrbanDictionaryAPIError) -> NoReturn:
         self._logger.error(f'{api_error=}', stacklevel=2)
         raise UrbanDictionaryAPIException(api_error=api_error)
 
+    def _unavailable(self, message: str) -> NoReturn:
+        self._error(api_error=UrbanDictionaryAPIError(error=message))
+
     async def get_autocomplete(self, term: str) -> AutocompletionList:
-        api_result = await self.client.get(f'{self.API_ENDPOINT}/autocomplete', params={'term': term})
+        with phase('cache'):
+            autocomplete_list = self.autocomplete_cache.get(term)
+        if autocomplete_list is not None:
+            return autocomplete_list
+
+        api_result = await self._get(
+            f'{self.API_ENDPOINT}/autocomplete',
+            endpoint='autocomplete',
+            params={'term': term},
+        )
+        with phase('parse'):
+            api_result_data = api_result.json()
 
         if api_result.status_code != httpx.codes.OK:
-            api_error = UrbanDictionaryAPIError(**api_result.json())
+            api_error = UrbanDictionaryAPIError(**api_result_data)
             self._error(api_error=api_error)
 
-        autocomplete_list = AutocompletionList(list=api_result.json())
+        with phase('parse'):
+            autocomplete_list = AutocompletionList(list=api_result_data)
+        self.autocomplete_cache.put(
+            term,
+            autocomplete_list,
+            age=get_response_age(api_result),
+            freshness=get_response_freshness(api_result),
+        )
         return autocomplete_list
 
     async def get_term(self, term: str) -> TermDefinitions:
-        api_result = await self.client.get(f'{self.API_ENDPOINT}/define', params={'term': term})
+        with phase('cache'):
+            term_definitions = self.term_cache.get(term)
+        if term_definitions is not None:
+            return term_definitions
+
+        api_result = await self._get(f'{self.API_ENDPOINT}/define', endpoint='define', params={'term': term})
+        with phase('parse'):
+            api_result_data = api_result.json()
 
         if api_result.status_code != httpx.codes.OK:
-            api_error = UrbanDictionaryAPIError(**api_result.json())
+            api_error = UrbanDictionaryAPIError(**api_result_data)
             self._error(api_error=api_error)
 
-        term_definitions = TermDefinitions(**api_result.json())
+        with phase('parse'):
+            term_definitions = TermDefinitions(**api_result_data)
+        self.term_cache.put(
+            term,
+            term_definitions,
+            age=get_response_age(api_result),
+            freshness=get_response_freshness(api_result),
+        )
         return term_definitions
@@ -1,9 +1,283 @@
 import asyncio
+from collections import OrderedDict
+from contextvars import Context
+import heapq
+from itertools import count
+import json
 import logging
-from time import time
-from typing import Any, Dict, NamedTuple
+import sys
+from time import monotonic, perf_counter, time
+from typing import Any, Dict, Generic, Hashable, Iterable, List, NamedTuple, Optional, Set, Tuple, TypeVar
+from weakref import WeakSet
 
-from httpx import AsyncHTTPTransport, Request, Response
+from httpx import AsyncHTTPTransport, ByteStream, codes, Request, Response, TransportError
+
+from .diskcache import CacheBackend, DiskCacheEntry
+from .metrics import Labels, make_labels, registry
+from .phases import phase
+from .scheduling import UpstreamScheduler, UpstreamUnavailableException
+
+
+KeyT = TypeVar('KeyT', bound=Hashable)
+ValueT = TypeVar('ValueT')
+
+
+# region Cache store
+class CacheStats(NamedTuple):
+    entries: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+    def __str__(self) -> str:
+        return (
+            f'{self.entries} entries, {self.size} bytes,'
+            f' {self.hits} hits, {self.misses} misses,'
+            f' {self.evictions} evictions, {self.expirations} expirations'
+        )
+
+
+class CacheEntry(NamedTuple, Generic[ValueT]):
+    value: ValueT
+    size: int
+    expires: float
+
+
+class CacheStore(Generic[KeyT, ValueT]):
+    """
+    Least recently used cache bounded by entry count and total size, with a heap of expiry times,
+    so that dropping expired entries only costs as much as there are expired entries
+
+    Named caches have their stats exported as metrics.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_size: Optional[int] = None,
+        name: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        if name is not None:
+            _named_cache_stores.add(self)
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        self._entries: OrderedDict[KeyT, CacheEntry[ValueT]] = OrderedDict()
+        self._expiry_heap: List[Tuple[float, int, KeyT]] = []
+        self._expiry_counter = count()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: KeyT) -> bool:
+        return key in self._entries
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            entries=len(self._entries),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+    def get(self, key: KeyT, record_stats: bool = True) -> Optional[ValueT]:
+        """
+        Value of an entry that hasn't expired yet, counted as a hit or miss
+        unless `record_stats` is false, for callers that count entries still kept but no longer usable as misses
+        """
+        entry = self._entries.get(key, None)
+
+        if entry is not None and entry.expires <= time():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            if record_stats:
+                self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        if record_stats:
+            self.hits += 1
+        return entry.value
+
+    def set(self, key: KeyT, value: ValueT, expires: float, size: int = 0) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = CacheEntry(value=value, size=size, expires=expires)
+        self.size += size
+        heapq.heappush(self._expiry_heap, (expires, next(self._expiry_counter), key))
+
+        while self._entries and self._is_over_capacity():
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+        # Overwritten and evicted entries leave their expiry times behind, don't let them pile up
+        if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(e.expires, next(self._expiry_counter), k) for k, e in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _is_over_capacity(self) -> bool:
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.max_size is not None and self.size > self.max_size
+
+    def pop(self, key: KeyT) -> Optional[ValueT]:
+        if key not in self._entries:
+            return None
+        return self._remove(key).value
+
+    def _remove(self, key: KeyT) -> CacheEntry[ValueT]:
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        return entry
+
+    def expire(self, now: float) -> List[KeyT]:
+        """Removes entries that have expired by `now`, returns their keys"""
+        expired = []
+
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires, _, key = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(key, None)
+
+            # Skip expiry times of entries that have since been overwritten or evicted
+            if entry is not None and entry.expires == expires:
+                self._remove(key)
+                self.expirations += 1
+                expired.append(key)
+
+        return expired
+
+    def next_expiry(self) -> Optional[float]:
+        return self._expiry_heap[0][0] if self._expiry_heap else None
+
+
+_named_cache_stores: 'WeakSet[CacheStore[Any, Any]]' = WeakSet()
+
+
+def _register_cache_stats_metric(field: str, metric_type: str, name: str, documentation: str) -> None:
+    def collect() -> Iterable[Tuple[Labels, float]]:
+        for store in list(_named_cache_stores):
+            yield make_labels(cache=str(store.name)), getattr(store.stats, field)
+
+    registry.callback(name, documentation, metric_type, collect)
+
+
+_register_cache_stats_metric('entries', 'gauge', 'nb4mna_cache_entries', 'Entries in cache')
+_register_cache_stats_metric('size', 'gauge', 'nb4mna_cache_size_bytes', 'Approximate size of cache entries')
+_register_cache_stats_metric('hits', 'counter', 'nb4mna_cache_hits_total', 'Cache lookups finding a fresh entry')
+_register_cache_stats_metric('misses', 'counter', 'nb4mna_cache_misses_total', 'Cache lookups finding no fresh entry')
+_register_cache_stats_metric('evictions', 'counter', 'nb4mna_cache_evictions_total', 'Entries evicted for space')
+_register_cache_stats_metric('expirations', 'counter', 'nb4mna_cache_expirations_total', 'Entries expired')
+# endregion
+
+
+# region Result cache
+def get_object_size(obj: object) -> int:
+    """Approximate memory taken by an object and everything it references, counting shared objects once"""
+    seen = set()
+    stack = [obj]
+    size = 0
+
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+
+    return size
+
+
+def get_response_age(response: Response) -> float:
+    try:
+        return float(response.headers.get('Age', 0))
+    except ValueError:
+        return 0.0
+
+
+def get_response_freshness(response: Response) -> Optional[float]:
+    """Seconds the response stays fresh for, if set by a transport going by upstream `Cache-Control`"""
+    freshness = response.extensions.get('nb4mna.freshness', None)
+    return float(freshness) if freshness is not None else None
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+class ResultCache(CacheStore[KeyT, ValueT]):
+    """
+    Cache of already parsed and validated API results, so that repeated calls skip decoding altogether
+
+    Results should be immutable, as the same object is handed out to every caller.
+    """
+
+    def __init__(
+        self,
+        duration: float,
+        max_entries: Optional[int] = 1024,
+        max_size: Optional[int] = None,
+        name: Optional[str] = None,
+    ) -> None:
+        super().__init__(max_entries=max_entries, max_size=max_size, name=name)
+        self.duration = duration
+
+    def put(self, key: KeyT, value: ValueT, age: float = 0.0, freshness: Optional[float] = None) -> None:
+        """
+        Caches a result, `age` being how long ago the response it was parsed from had been received,
+        and `freshness` how much longer that response stays fresh, if not for the cache duration
+        """
+        expires_in = self.duration - age if freshness is None else freshness
+        self.set(key, value, expires=time() + expires_in, size=get_object_size(value))
+# endregion
+
+
+# region HTTP transport
+stale_responses = registry.counter(
+    'nb4mna_cache_stale_responses_total',
+    'Expired responses served from cache, while revalidating or because the upstream failed',
+)
+upstream_request_duration = registry.histogram(
+    'nb4mna_upstream_request_duration_seconds',
+    'Time taken by upstream requests, per API and endpoint',
+)
+upstream_responses = registry.counter(
+    'nb4mna_upstream_responses_total',
+    'Upstream responses per API, endpoint and status (or "error" and "unavailable" for failed requests)',
+)
+upstream_hedged_requests = registry.counter(
+    'nb4mna_upstream_hedged_requests_total',
+    'Upstream requests sent once more for taking unusually long, per API and endpoint',
+)
 
 
 class CacheKey(NamedTuple):
@@ -17,17 +291,67 @@ class CacheKey(NamedTuple):
 class CacheValue(NamedTuple):
     response: Response
     time: float
+    # Seconds after `time` the response stays fresh for
+    lifetime: float
 
 
 class AsyncCachedHTTPTransport(AsyncHTTPTransport):
-    def __init__(self, *args: Any, cache_duration: float, **kwargs: Any) -> None:
+    LEASE_POLL_INTERVAL = 0.05
+
+    def __init__(
+        self,
+        *args: Any,
+        name: str,
+        cache_duration: float,
+        cache_max_entries: Optional[int] = 1024,
+        cache_max_size: Optional[int] = 16 * 1024 * 1024,
+        stale_while_revalidate: bool = False,
+        max_stale: float = 0.0,
+        conditional_requests: bool = False,
+        revalidation_window: float = 3600.0,
+        respect_cache_control: bool = False,
+        backend: Optional[CacheBackend] = None,
+        lease_timeout: float = 10.0,
+        scheduler: Optional[UpstreamScheduler] = None,
+        **kwargs: Any,
+    ) -> None:
         super().__init__(*args, **kwargs)
 
         self._logger = logging.getLogger('nb4mna.caching')
 
-        self.cache: Dict[CacheKey, CacheValue] = {}
+        self.name = name
+        self.cache: CacheStore[CacheKey, CacheValue] = CacheStore(
+            max_entries=cache_max_entries,
+            max_size=cache_max_size,
+            name=name,
+        )
+        # Responses are fresh for `cache_duration`, or for as long as their `Cache-Control` header says if respected
         self.cache_duration = cache_duration
-        self.cache_write_lock = asyncio.Lock()
+        self.respect_cache_control = respect_cache_control
+
+        # Expired responses are kept for `max_stale` more seconds, to be served while they're being refreshed
+        # (if `stale_while_revalidate` is enabled) or when the upstream fails
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self.revalidation_tasks: Set[asyncio.Task[Response]] = set()
+
+        # Expired responses with an `ETag` or `Last-Modified` header are refreshed with a conditional request,
+        # so that an unchanged response is only renewed instead of downloaded again;
+        # they're kept for `revalidation_window` more seconds to that end
+        self.conditional_requests = conditional_requests
+        self.revalidation_window = revalidation_window
+
+        # Responses missing from memory are looked up in the backend, and saved responses are stored in it
+        # A backend shared with other processes also decides which one fetches a response, the others wait for it
+        # for up to `lease_timeout` seconds
+        self.backend = backend
+        self.lease_timeout = lease_timeout
+
+        # Paces the requests that actually go upstream, cache hits aren't affected
+        self.scheduler = scheduler
+
+        # Upstream requests currently being made, shared by all concurrent cache misses for the same key
+        self.in_flight: Dict[CacheKey, asyncio.Future[Response]] = {}
 
         self.cache_clear_task = asyncio.create_task(self.clear_cache_task())
 
@@ -35,42 +359,421 @@ class AsyncCachedHTTPTransport(AsyncHTTPTransport):
     def get_cache_key(request: Request) -> CacheKey:
         return CacheKey(method=request.method, url=str(request.url))
 
+    def get_freshness_lifetime(self, response: Response) -> float:
+        if self.respect_cache_control:
+            directives = parse_cache_control(response.headers.get('Cache-Control', ''))
+            if 'no-cache' in directives:
+                return 0.0
+
+            max_age = directives.get('s-maxage', None) or directives.get('max-age', None)
+            if max_age is not None:
+                try:
+                    return max(0.0, float(max_age) - get_response_age(response))
+                except ValueError:
+                    pass
+
+        return self.cache_duration
+
+    def is_fresh(self, cache_value: CacheValue) -> bool:
+        return time() - cache_value.time <= cache_value.lifetime
+
+    def is_usable_stale(self, cache_value: CacheValue) -> bool:
+        """Whether an expired response may be served, rather than only be used to revalidate it"""
+        return time() - cache_value.time <= cache_value.lifetime + self.max_stale
+
+    @staticmethod
+    def has_validators(response: Response) -> bool:
+        return 'ETag' in response.headers or 'Last-Modified' in response.headers
+
     @staticmethod
-    def is_request_response_cacheable(request: Request, response: Response) -> bool:
+    def make_conditional_request(request: Request, response: Response) -> Request:
+        headers = request.headers.copy()
+        if 'ETag' in response.headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+
+        return Request(request.method, request.url, headers=headers, extensions=request.extensions)
+
+    @staticmethod
+    def renew_response(response: Response, not_modified: Response) -> Response:
+        """Stored response updated with the headers of a `304 Not Modified` response to a conditional request"""
+        headers = response.headers.copy()
+        for key in ('Cache-Control', 'Date', 'ETag', 'Expires', 'Last-Modified'):
+            if key in not_modified.headers:
+                headers[key] = not_modified.headers[key]
+        headers.pop('Age', None)
+
+        return Response(
+            status_code=response.status_code,
+            headers=headers,
+            stream=response.stream,
+            extensions=response.extensions,
+        )
+
+    @staticmethod
+    def get_response_content(response: Response) -> bytes:
+        """Returns the raw (not decoded) body of a response made by `read_response()`"""
+        return b''.join(response.stream) if isinstance(response.stream, ByteStream) else b''
+
+    @classmethod
+    def get_response_size(cls, response: Response) -> int:
+        headers_size = sum(len(key) + len(value) for key, value in response.headers.raw)
+        return headers_size + len(cls.get_response_content(response))
+
+    @classmethod
+    def dump_response(cls, response: Response) -> bytes:
+        meta = {
+            'status_code': response.status_code,
+            'headers': [(key.decode('latin-1'), value.decode('latin-1')) for key, value in response.headers.raw],
+            'extensions': {key: value.decode('latin-1') for key, value in response.extensions.items()},
+        }
+        return json.dumps(meta).encode() + b'\n' + cls.get_response_content(response)
+
+    @staticmethod
+    def load_response(data: bytes) -> Response:
+        meta_json, _, content = data.partition(b'\n')
+        meta = json.loads(meta_json)
+
+        return Response(
+            status_code=meta['status_code'],
+            headers=[(key.encode('latin-1'), value.encode('latin-1')) for key, value in meta['headers']],
+            stream=ByteStream(content),
+            extensions={key: value.encode('latin-1') for key, value in meta['extensions'].items()},
+        )
+
+    @staticmethod
+    def is_request_coalescable(request: Request) -> bool:
+        return request.method == 'GET'
+
+    def is_request_response_cacheable(self, request: Request, response: Response) -> bool:
+        if response.status_code == codes.TOO_MANY_REQUESTS:
+            return False
+        if self.respect_cache_control and 'no-store' in parse_cache_control(response.headers.get('Cache-Control', '')):
+            return False
         return request.method == 'GET' and response.status_code < 500
 
+    @staticmethod
+    async def read_response(response: Response) -> Response:
+        """Reads the upstream response body, so that the resulting response can be handed out more than once"""
+        content = b''.join([chunk async for chunk in response.aiter_raw()])
+
+        return Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=ByteStream(content),
+            extensions={
+                key: value for key, value in response.extensions.items() if key in ('http_version', 'reason_phrase')
+            },
+        )
+
+    def copy_response(self, response: Response, time_cached: Optional[float] = None) -> Response:
+        """
+        Makes a fresh response for a caller, sharing the already read body of a cached or coalesced response
+
+        Responses taken from cache get an `Age` header, like they would from any other HTTP cache.
+        When going by `Cache-Control`, how much longer the response stays fresh is passed along to callers
+        in the `nb4mna.freshness` extension, see `get_response_freshness()`.
+        """
+        headers = response.headers
+        age = 0.0
+        if time_cached is not None:
+            age = time() - time_cached
+            headers = headers.copy()
+            headers['Age'] = str(int(age))
+
+        extensions = response.extensions
+        if self.respect_cache_control:
+            extensions = {**extensions, 'nb4mna.freshness': max(0.0, self.get_freshness_lifetime(response) - age)}
+
+        return Response(
+            status_code=response.status_code,
+            headers=headers,
+            stream=response.stream,
+            extensions=extensions,
+        )
+
     async def clear_cache_task(self) -> None:
-        self._logger.debug(f'Started periodic cache clearing task (every {self.cache_duration:.0f} seconds)')
+        self._logger.debug(f'Started cache expiry task (at least every {self.cache_duration:.0f} seconds)')
 
         while True:
-            async with self.cache_write_lock:
-                now = time()
-                for cache_key in list(self.cache.keys()):
-                    if (now - self.cache[cache_key].time) > self.cache_duration:
-                        self._logger.debug(f'{cache_key}: expired, clearing from cache')
-                        self.cache.pop(cache_key)
+            now = time()
+
+            expired = self.cache.expire(now)
+            if expired:
+                self._logger.debug(f'Cleared {len(expired)} expired entries from cache ({self.cache.stats})')
+
+            # Wake up when the next entry expires, but no later than a cache duration from now
+            next_expiry = self.cache.next_expiry()
+            delay = self.cache_duration if next_expiry is None else min(next_expiry - now, self.cache_duration)
+            await asyncio.sleep(max(delay, 0.0))
+
+    @staticmethod
+    def get_endpoint(request: Request) -> str:
+        """Endpoint name for metrics, set by API clients in request extensions to avoid IDs in URL paths"""
+        return str(request.extensions.get('nb4mna.endpoint', request.url.path))
+
+    async def send_upstream(self, request: Request) -> Response:
+        endpoint = self.get_endpoint(request)
+        start = perf_counter()
+
+        try:
+            response = await self.read_response(await super().handle_async_request(request))
+        except TransportError:
+            upstream_responses.inc(api=self.name, endpoint=endpoint, status='error')
+            raise
+        finally:
+            duration = perf_counter() - start
+            upstream_request_duration.observe(duration, api=self.name, endpoint=endpoint)
+
+        upstream_responses.inc(api=self.name, endpoint=endpoint, status=str(response.status_code))
+        if self.scheduler is not None:
+            self.scheduler.record_response_time(endpoint, duration)
+        return response
+
+    async def send_scheduled(self, request: Request) -> Response:
+        if self.scheduler is None:
+            return await self.send_upstream(request)
+
+        try:
+            return await self.scheduler.send(self.send_upstream, request)
+        except UpstreamUnavailableException:
+            upstream_responses.inc(api=self.name, endpoint=self.get_endpoint(request), status='unavailable')
+            raise
+
+    async def send_hedged(self, request: Request) -> Response:
+        """
+        Sends a request upstream, and sends it once more if the response takes unusually long,
+        using whichever response comes first
+        """
+        endpoint = self.get_endpoint(request)
+        hedge_delay = None
+        if self.scheduler is not None and self.is_request_coalescable(request):
+            hedge_delay = self.scheduler.hedge_delay(endpoint)
+
+        if hedge_delay is None:
+            return await self.send_scheduled(request)
+
+        attempts = {asyncio.create_task(self.send_scheduled(request))}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+            if not done:
+                self._logger.debug('%s: no response in %.3f seconds, hedging', request.url, hedge_delay)
+                upstream_hedged_requests.inc(api=self.name, endpoint=endpoint)
+                attempts.add(asyncio.create_task(self.send_scheduled(request)))
+
+            while True:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                # Either response will do, the request only fails once both attempts have
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+                if not attempts:
+                    return done.pop().result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def fetch(self, request: Request, cache_key: CacheKey, cache_value: Optional[CacheValue] = None) -> Response:
+        """Fetches a response from upstream, conditionally if there's an expired `cache_value` to revalidate"""
+        stale_response = None
+        if self.conditional_requests and cache_value and self.is_request_coalescable(request):
+            if self.has_validators(cache_value.response):
+                stale_response = cache_value.response
+                request = self.make_conditional_request(request, stale_response)
+
+        response = await self.send_hedged(request)
 
-            await asyncio.sleep(self.cache_duration)
+        if stale_response is not None and response.status_code == codes.NOT_MODIFIED:
+            self._logger.debug('%s: not modified, renewing %s', cache_key, cache_value)
+            response = self.renew_response(stale_response, response)
+
+        if self.is_request_response_cacheable(request, response):
+            self._logger.debug('%s: saving %s', cache_key, response)
+            now = time()
+            lifetime = self.get_freshness_lifetime(response)
+            # Keep the response around for long enough to serve it stale, or to revalidate it
+            retention = self.max_stale
+            if self.conditional_requests and self.has_validators(response):
+                retention = max(retention, self.revalidation_window)
+            expires = now + lifetime + retention
+            self.cache.set(
+                cache_key,
+                CacheValue(response=response, time=now, lifetime=lifetime),
+                expires=expires,
+                size=self.get_response_size(response),
+            )
+
+            if self.backend is not None:
+                self.backend.put(
+                    str(cache_key),
+                    DiskCacheEntry(value=self.dump_response(response), time=now, expires=expires),
+                )
+        else:
+            self._logger.debug('%s: not caching, ineligible', cache_key)
+
+        return response
+
+    def load_backend_entry(self, cache_key: CacheKey, entry: DiskCacheEntry) -> CacheValue:
+        """Caches an entry read from the backend in memory"""
+        response = self.load_response(entry.value)
+        cache_value = CacheValue(response=response, time=entry.time, lifetime=self.get_freshness_lifetime(response))
+        self._logger.debug('%s: loaded %s from backend', cache_key, cache_value)
+
+        self.cache.set(cache_key, cache_value, expires=entry.expires, size=self.get_response_size(response))
+        return cache_value
+
+    async def load_from_backend(self, cache_key: CacheKey) -> Optional[CacheValue]:
+        if self.backend is None:
+            return None
+
+        entry = await self.backend.get(str(cache_key))
+        if entry is None:
+            return None
+        return self.load_backend_entry(cache_key, entry)
+
+    async def fetch_leased(
+        self, request: Request, cache_key: CacheKey, cache_value: Optional[CacheValue] = None
+    ) -> Response:
+        """Fetches a response, unless another process sharing the backend already is, then waits for its response"""
+        if self.backend is None:
+            return await self.fetch(request, cache_key, cache_value)
+
+        key = str(cache_key)
+        deadline = monotonic() + self.lease_timeout
+
+        while not await self.backend.acquire_lease(key, self.lease_timeout):
+            if monotonic() >= deadline:
+                self._logger.warning('%s: gave up waiting for another process, fetching', cache_key)
+                break
+
+            await asyncio.sleep(self.LEASE_POLL_INTERVAL)
+
+            # Only a newer entry than the one already at hand is the response being waited for, worth loading
+            entry = await self.backend.get(key)
+            if entry is None or (cache_value is not None and entry.time <= cache_value.time):
+                continue
+
+            fetched = self.load_backend_entry(cache_key, entry)
+            if self.is_fresh(fetched):
+                self._logger.debug('%s: using %s fetched by another process', cache_key, fetched)
+                return fetched.response
+
+            # Already stale when stored, nothing better will come from waiting
+            break
+
+        try:
+            return await self.fetch(request, cache_key, cache_value)
+        finally:
+            self.backend.release_lease(key)
+
+    async def fetch_coalesced(
+        self, request: Request, cache_key: CacheKey, cache_value: Optional[CacheValue] = None
+    ) -> Response:
+        while (in_flight := self.in_flight.get(cache_key, None)) is not None:
+            self._logger.debug('%s: waiting for in-flight request', cache_key)
+            try:
+                # Shielded, so that a single waiter being cancelled doesn't cancel the request for everyone else
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                task = asyncio.current_task()
+                if not in_flight.cancelled() or (task is not None and task.cancelling()):
+                    raise
+                # The request was cancelled along with the caller that made it, such as at its deadline,
+                # which shouldn't cut short the others waiting, so one of them makes the request anew
+                self._logger.debug('%s: in-flight request cancelled, retrying', cache_key)
+
+        in_flight = asyncio.get_running_loop().create_future()
+        # Retrieve the outcome, so that a failure without any waiters doesn't get reported as never retrieved
+        in_flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.in_flight[cache_key] = in_flight
+
+        try:
+            response = await self.fetch_leased(request, cache_key, cache_value)
+        except asyncio.CancelledError:
+            in_flight.cancel()
+            raise
+        except Exception as e:
+            in_flight.set_exception(e)
+            raise
+        else:
+            in_flight.set_result(response)
+            return response
+        finally:
+            self.in_flight.pop(cache_key, None)
+
+    def revalidate(self, request: Request, cache_key: CacheKey, cache_value: CacheValue) -> None:
+        if cache_key in self.in_flight:
+            return
+
+        self._logger.debug('%s: refreshing in background', cache_key)
+        # In a context of its own, so that it isn't cut short by the deadline of the request that started it
+        task = asyncio.create_task(self.fetch_coalesced(request, cache_key, cache_value), context=Context())
+        self.revalidation_tasks.add(task)
+        task.add_done_callback(self._revalidation_done)
+
+    def _revalidation_done(self, task: asyncio.Task[Response]) -> None:
+        self.revalidation_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.warning(f'Background refresh failed: {task.exception()!r}')
 
     async def handle_async_request(self, request: Request) -> Response:
+        # Pings, made only to keep connections open, aren't cached nor count against the upstream's rate limit
+        if request.extensions.get('nb4mna.ping', False):
+            return await self.send_upstream(request)
+
         cache_key = self.get_cache_key(request)
-        cache_value = self.cache.get(cache_key, None)
-
-        if not cache_value or time() - cache_value.time > self.cache_duration:
-            self._logger.debug(f'{cache_key}: cached response unavailable or expired')
-            response = await super().handle_async_request(request)
-
-            if self.is_request_response_cacheable(request, response):
-                self._logger.debug(f'{cache_key}: saving {response}')
-                async with self.cache_write_lock:
-                    self.cache[cache_key] = CacheValue(
-                        response=response,
-                        time=time(),
-                    )
-            else:
-                self._logger.debug(f'{cache_key}: not caching, ineligible')
+        with phase('cache'):
+            cache_value = self.cache.get(cache_key, record_stats=False) or await self.load_from_backend(cache_key)
 
-            return response
-        else:
-            self._logger.debug(f'{cache_key}: using cached {cache_value}')
-            return cache_value.response
+        # Expired responses are kept to be served stale or revalidated, but only fresh ones count as hits,
+        # stale ones served are counted separately
+        if cache_value and self.is_fresh(cache_value):
+            self.cache.hits += 1
+            self._logger.debug('%s: using cached %s', cache_key, cache_value)
+            return self.copy_response(cache_value.response, cache_value.time)
+        self.cache.misses += 1
+
+        # Expired responses may be kept for longer than they may be served, only to be revalidated
+        usable_stale = cache_value is not None and self.is_usable_stale(cache_value)
+
+        if cache_value and usable_stale and self.stale_while_revalidate and self.is_request_coalescable(request):
+            self._logger.debug('%s: using stale %s', cache_key, cache_value)
+            stale_responses.inc(cache=self.name, reason='revalidating')
+            self.revalidate(request, cache_key, cache_value)
+            return self.copy_response(cache_value.response, cache_value.time)
+
+        self._logger.debug('%s: cached response unavailable or expired', cache_key)
+
+        try:
+            with phase('upstream'):
+                if self.is_request_coalescable(request):
+                    response = await self.fetch_coalesced(request, cache_key, cache_value)
+                else:
+                    response = await self.fetch(request, cache_key, cache_value)
+        except (TransportError, UpstreamUnavailableException) as e:
+            if not cache_value or not usable_stale:
+                raise
+            self._logger.warning('%s: upstream failed (%r), using stale %s', cache_key, e, cache_value)
+            stale_responses.inc(cache=self.name, reason='error')
+            return self.copy_response(cache_value.response, cache_value.time)
+
+        if cache_value and usable_stale and response.status_code >= 500:
+            self._logger.warning('%s: upstream failed (%s), using stale %s', cache_key, response, cache_value)
+            stale_responses.inc(cache=self.name, reason='error')
+            return self.copy_response(cache_value.response, cache_value.time)
+
+        return self.copy_response(response)
+
+    async def aclose(self) -> None:
+        """Stops background tasks, closes the backend and the connection pool"""
+        tasks = [self.cache_clear_task, *self.revalidation_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.backend is not None:
+            await self.backend.aclose()
+
+        await super().aclose()
+# endregion
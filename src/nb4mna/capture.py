@@ -0,0 +1,174 @@
+"""
+Capture of incoming commands, for replaying them against the app later with `python -m benchmarks.replay`
+
+Each command is a line of JSON: its arrival time `t`, path `p`, query parameters `q`,
+and the `Nightbot-User` and `Nightbot-Channel` headers `u` and `c`, if any. Names and IDs of users and channels,
+including users mentioned in parameters, are replaced by keyed hashes, consistent within a capture using one key.
+The response URL, being a token of its own, isn't kept at all.
+"""
+
+import asyncio
+from hashlib import blake2b
+import json
+import logging
+import os
+from pathlib import Path
+from random import random
+import re
+from secrets import token_hex
+from time import time
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI
+from pydantic import BaseModel
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .clients import ClientHandle, clients
+
+
+class CaptureSettings(BaseModel):
+    # Append captured commands to this file, disabled if not set
+    path: Optional[Path] = None
+    # Key of the hashes replacing names and IDs, which only match between captures using the same key;
+    # a random one is used if not set
+    key: Optional[str] = None
+    # Paths of requests captured, and the fraction of them
+    paths: List[str] = ['/fight/', '/urban/']
+    sample_rate: float = 1.0
+    # Seconds between writes to the file
+    flush_interval: float = 1.0
+
+
+# Fields of the Nightbot headers kept in captures, with whether their values are hashed
+HEADER_FIELDS = {
+    'name': True,
+    'displayName': True,
+    'provider': False,
+    'providerId': True,
+    'userLevel': False,
+}
+
+# Discord mentions like <@123> and <@!123>, and Twitch ones like @name
+MENTION_REGEX = re.compile(r'(?<=<@)!?\d+(?=>)|(?<=@)\w+')
+
+
+def hash_value(key: bytes, value: str) -> str:
+    """Keyed hash of a name or ID, as digits, so that it still passes for a Discord user ID"""
+    return str(int.from_bytes(blake2b(value.encode(), key=key, digest_size=7).digest()))
+
+
+class CaptureWriter:
+    """
+    Appends lines to a file, several processes at once
+
+    Lines are buffered and written every `flush_interval` seconds, each batch with a single write
+    to a file opened for appending, so that batches of different processes don't interleave.
+    """
+
+    def __init__(self, path: Path, flush_interval: float) -> None:
+        self._logger = logging.getLogger('nb4mna.capture')
+
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.lines: List[str] = []
+
+        self.flush_task_ = asyncio.create_task(self.flush_task(flush_interval))
+
+    def write(self, line: str) -> None:
+        self.lines.append(line)
+
+    def flush(self) -> None:
+        if not self.lines:
+            return
+
+        data, self.lines = ''.join(self.lines).encode(), []
+        try:
+            os.write(self.fd, data)
+        except OSError as e:
+            self._logger.warning('Failed to write capture to %s: %r', self.path, e)
+
+    async def flush_task(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    async def aclose(self) -> None:
+        self.flush_task_.cancel()
+        await asyncio.gather(self.flush_task_, return_exceptions=True)
+
+        self.flush()
+        os.close(self.fd)
+
+
+class CaptureMiddleware:
+    """Captures requests to some paths, anonymized, into a file written by a `CaptureWriter`"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        writer: ClientHandle[CaptureWriter],
+        key: str,
+        paths: Sequence[str],
+        sample_rate: float = 1.0,
+    ) -> None:
+        self.app = app
+        self.writer = writer
+        self.key = key.encode()
+        self.paths = frozenset(paths)
+        self.sample_rate = sample_rate
+
+    def anonymize_header(self, value: str) -> Dict[str, str]:
+        return {
+            field: hash_value(self.key, field_value) if HEADER_FIELDS[field] else field_value
+            for field, field_value in parse_qsl(value)
+            if field in HEADER_FIELDS
+        }
+
+    def anonymize_parameter(self, value: str) -> str:
+        return MENTION_REGEX.sub(lambda m: hash_value(self.key, m.group(0).lstrip('!')), value)
+
+    def record(self, scope: Scope) -> Dict[str, Any]:
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        record: Dict[str, Any] = {
+            't': round(time(), 3),
+            'p': scope['path'],
+            'q': {
+                name: self.anonymize_parameter(value)
+                for name, value in parse_qsl(scope['query_string'].decode('latin-1'))
+            },
+        }
+
+        user: Optional[str] = headers.get('nightbot-user', None)
+        if user is not None:
+            record['u'] = self.anonymize_header(user)
+        channel: Optional[str] = headers.get('nightbot-channel', None)
+        if channel is not None:
+            record['c'] = self.anonymize_header(channel)
+
+        return record
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'] in self.paths and random() < self.sample_rate:
+            line = json.dumps(self.record(scope), ensure_ascii=False, separators=(',', ':'))
+            self.writer.get().write(line + '\n')
+
+        await self.app(scope, receive, send)
+
+
+def install(app: FastAPI, settings: CaptureSettings) -> None:
+    path = settings.path
+    if path is None:
+        return
+
+    key = settings.key
+    if key is None:
+        key = token_hex(16)
+        logging.getLogger('nb4mna.capture').warning(
+            'No capture key set, hashes in %s will only match within this process', path
+        )
+
+    writer = clients.register('capture', lambda: CaptureWriter(path, settings.flush_interval))
+    app.add_middleware(
+        CaptureMiddleware, writer=writer, key=key, paths=settings.paths, sample_rate=settings.sample_rate
+    )
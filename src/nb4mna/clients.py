@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Callable, Generic, List, Optional, Protocol, Type, TypeVar
+
+import httpx
+from pydantic import BaseModel
+
+from .caching import AsyncCachedHTTPTransport
+from .diskcache import CacheBackend, SharedSQLiteCacheBackend, SQLiteCacheTier
+from .scheduling import UpstreamScheduler
+
+
+class HTTPClientSettings(BaseModel):
+    http2: bool = True
+
+    # Connection pool size per API, and how long idle connections are kept open
+    max_connections: Optional[int] = 100
+    max_keepalive_connections: Optional[int] = 20
+    keepalive_expiry: Optional[float] = 5.0
+
+    connect_timeout: Optional[float] = 5.0
+    read_timeout: Optional[float] = 5.0
+    write_timeout: Optional[float] = 5.0
+    pool_timeout: Optional[float] = 5.0
+
+
+class HTTPCacheSettings(BaseModel):
+    # Responses are fresh for this long, and kept for `max_stale` more seconds to be served while they're refreshed
+    # in the background (if `stale_while_revalidate` is enabled) or when the API fails
+    duration: float = 60.0
+    stale_while_revalidate: bool = False
+    max_stale: float = 0.0
+    # Refresh expired responses with conditional requests if they have an `ETag` or `Last-Modified` header,
+    # keeping them for `revalidation_window` more seconds to do so
+    conditional_requests: bool = False
+    revalidation_window: float = 3600.0
+    # Keep responses fresh for as long as their `Cache-Control` header says, rather than `duration`
+    respect_cache_control: bool = False
+    # Responses kept in memory at most, and their total size in bytes; unlimited if not set
+    max_entries: Optional[int] = 1024
+    max_size: Optional[int] = 16 * 1024 * 1024
+
+
+class CacheSettings(BaseModel):
+    # SQLite database keeping cached responses across restarts, disabled if not set
+    disk_path: Optional[Path] = None
+    # Share that database with other processes on the same host, along with their requests in flight,
+    # waiting up to `lease_timeout` seconds for another process to fetch a response rather than fetching it again
+    shared: bool = False
+    lease_timeout: float = 10.0
+
+
+def create_cache_backend(name: str, settings: CacheSettings) -> Optional[CacheBackend]:
+    if settings.disk_path is None:
+        return None
+    if settings.shared:
+        return SharedSQLiteCacheBackend(settings.disk_path, namespace=name)
+    return SQLiteCacheTier(settings.disk_path, namespace=name)
+
+
+def create_http_client(
+    name: str,
+    settings: HTTPClientSettings,
+    cache_settings: HTTPCacheSettings,
+    disk_cache_settings: CacheSettings,
+    scheduler: Optional[UpstreamScheduler] = None,
+) -> httpx.AsyncClient:
+    """Creates an HTTP client for an upstream API, with its own cache and connection pool"""
+    return httpx.AsyncClient(
+        http2=settings.http2,
+        timeout=httpx.Timeout(
+            connect=settings.connect_timeout,
+            read=settings.read_timeout,
+            write=settings.write_timeout,
+            pool=settings.pool_timeout,
+        ),
+        transport=AsyncCachedHTTPTransport(
+            http2=settings.http2,
+            limits=httpx.Limits(
+                max_connections=settings.max_connections,
+                max_keepalive_connections=settings.max_keepalive_connections,
+                keepalive_expiry=settings.keepalive_expiry,
+            ),
+            name=name,
+            cache_duration=cache_settings.duration,
+            cache_max_entries=cache_settings.max_entries,
+            cache_max_size=cache_settings.max_size,
+            stale_while_revalidate=cache_settings.stale_while_revalidate,
+            max_stale=cache_settings.max_stale,
+            conditional_requests=cache_settings.conditional_requests,
+            revalidation_window=cache_settings.revalidation_window,
+            respect_cache_control=cache_settings.respect_cache_control,
+            backend=create_cache_backend(name, disk_cache_settings),
+            lease_timeout=disk_cache_settings.lease_timeout,
+            scheduler=scheduler,
+        ),
+    )
+
+
+class Closeable(Protocol):
+    async def aclose(self) -> None:
+        ...
+
+
+ClientT = TypeVar('ClientT', bound=Closeable)
+
+
+class ClientHandle(Generic[ClientT]):
+    """Client registered with a `ClientRegistry`, which exists only while the registry is started"""
+
+    def __init__(self, name: str, factory: Callable[[], ClientT]) -> None:
+        self.name = name
+        self.factory = factory
+        self.client: Optional[ClientT] = None
+
+    def get(self) -> ClientT:
+        if self.client is None:
+            raise RuntimeError(f'Client {self.name!r} is not started')
+        return self.client
+
+
+class ClientRegistry:
+    """
+    Clients of upstream APIs, along with their background tasks, owned by the app's lifespan
+
+    Clients are created on startup, in order of registration, and closed in reverse order on shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._logger = logging.getLogger('nb4mna.clients')
+        self.handles: List[ClientHandle[Any]] = []
+
+    def register(self, name: str, factory: Callable[[], ClientT]) -> ClientHandle[ClientT]:
+        handle = ClientHandle(name, factory)
+        self.handles.append(handle)
+        return handle
+
+    async def start(self) -> None:
+        for handle in self.handles:
+            if handle.client is None:
+                handle.client = handle.factory()
+                self._logger.debug('Started client %r', handle.name)
+
+    async def close(self) -> None:
+        for handle in reversed(self.handles):
+            if handle.client is None:
+                continue
+
+            client, handle.client = handle.client, None
+            try:
+                await client.aclose()
+            except Exception as e:
+                self._logger.warning('Failed to close client %r: %r', handle.name, e)
+            else:
+                self._logger.debug('Closed client %r', handle.name)
+
+    async def __aenter__(self) -> 'ClientRegistry':
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        # Closing shouldn't be cut short by the cancellation of whatever is shutting the app down
+        await asyncio.shield(self.close())
+
+
+clients = ClientRegistry()
@@ -0,0 +1,66 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from time import monotonic
+from typing import Awaitable, Iterator, NamedTuple, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+
+class Deadline(NamedTuple):
+    # In terms of `time.monotonic()`
+    time: float
+    timeout: float
+
+    def remaining(self) -> float:
+        return self.time - monotonic()
+
+
+# Deadline of the request being handled, inherited by the tasks it starts
+_deadline: ContextVar[Optional[Deadline]] = ContextVar('nb4mna.deadline', default=None)
+
+
+# region Exceptions
+@dataclass
+class DeadlineExceededException(Exception):
+    timeout: float
+
+    def __str__(self) -> str:
+        return f'no response in {self.timeout:g} seconds'
+# endregion
+
+
+def get_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(timeout: Optional[float]) -> Iterator[None]:
+    """Sets a deadline `timeout` seconds from now for upstream calls made within, unless there's an earlier one"""
+    current = _deadline.get()
+    if timeout is None or (current is not None and current.remaining() <= timeout):
+        yield
+        return
+
+    token = _deadline.set(Deadline(time=monotonic() + timeout, timeout=timeout))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+async def within_deadline(awaitable: Awaitable[T]) -> T:
+    """Awaits `awaitable`, cancelling it if the current deadline passes first"""
+    current = _deadline.get()
+    if current is None:
+        return await awaitable
+
+    try:
+        async with asyncio.timeout(current.remaining()) as timeout:
+            return await awaitable
+    except TimeoutError:
+        if timeout.expired():
+            raise DeadlineExceededException(timeout=current.timeout) from None
+        raise
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from secrets import compare_digest
+import sys
+import threading
+from time import monotonic, perf_counter, sleep
+from types import FrameType
+from typing import Callable, Dict, Optional
+
+from fastapi import FastAPI, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from .clients import clients
+from .metrics import registry
+
+
+class DiagnosticsSettings(BaseModel):
+    # Time how long each request spends parsing headers, looking up caches, waiting for upstream APIs and rendering
+    phase_timings: bool = False
+    # Measure how late the event loop wakes up every `loop_lag_interval` seconds, disabled if not set,
+    # warning when it's later than `loop_lag_threshold`
+    loop_lag_interval: Optional[float] = None
+    loop_lag_threshold: float = 0.1
+    # Warn about callbacks blocking the event loop for longer than this, along with the request they ran for;
+    # disabled if not set, and only available on the default asyncio event loop, not on uvloop
+    slow_callback_duration: Optional[float] = None
+    # Serve `/debug/profile/` to requests with an `Authorization: Bearer <profiler_token>` header,
+    # sampling the stack of the event loop thread every `profiler_interval` seconds
+    # for as many seconds as asked, up to `profiler_max_duration`; not served without a token
+    profiler: bool = False
+    profiler_token: Optional[str] = None
+    profiler_interval: float = 0.005
+    profiler_max_duration: float = 60.0
+
+
+loop_lag = registry.histogram(
+    'nb4mna_event_loop_lag_seconds',
+    'How late the event loop wakes up from sleeping, due to callbacks blocking it',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+slow_callbacks = registry.counter(
+    'nb4mna_slow_callbacks_total',
+    'Callbacks blocking the event loop for longer than the configured duration',
+)
+
+
+_run_handle: Callable[[asyncio.Handle], None] = asyncio.Handle._run
+
+
+def describe_callback(handle: asyncio.Handle) -> str:
+    # Steps of a task are bound to the task, which is far more telling than the step itself
+    task = getattr(handle._callback, '__self__', None)  # type: ignore[attr-defined]
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        return f'task {task.get_name()!r} running {getattr(coro, "__qualname__", coro)}'
+    return repr(handle)
+
+
+class LoopMonitor:
+    """
+    Reports the event loop being blocked: how late it wakes up from sleeping,
+    and which callbacks block it for too long
+
+    Slow callbacks are timed by wrapping `asyncio.Handle._run`, which the default event loop runs every callback
+    through, and are logged within their own context, so that they're tagged with their request's correlation ID.
+    """
+
+    def __init__(self, settings: DiagnosticsSettings) -> None:
+        self._logger = logging.getLogger('nb4mna.diagnostics')
+
+        self.settings = settings
+
+        self.loop_lag_task_: Optional[asyncio.Task[None]] = None
+        if settings.loop_lag_interval is not None:
+            self.loop_lag_task_ = asyncio.create_task(self.loop_lag_task(settings.loop_lag_interval))
+
+        self.reporting_slow_callbacks = False
+        if settings.slow_callback_duration is not None:
+            self.report_slow_callbacks(settings.slow_callback_duration)
+
+    async def loop_lag_task(self, interval: float) -> None:
+        while True:
+            start = monotonic()
+            await asyncio.sleep(interval)
+            lag = monotonic() - start - interval
+
+            loop_lag.observe(lag)
+            if lag >= self.settings.loop_lag_threshold:
+                self._logger.warning('Event loop lagged by %.3f seconds', lag)
+
+    def report_slow_callbacks(self, duration: float) -> None:
+        # Other event loops, like uvloop, run callbacks without going through `asyncio.Handle._run`
+        loop = asyncio.get_running_loop()
+        if not isinstance(loop, asyncio.BaseEventLoop):
+            self._logger.warning(
+                'Not reporting slow callbacks, only possible with the default asyncio event loop, not %s.%s',
+                type(loop).__module__,
+                type(loop).__qualname__,
+            )
+            return
+
+        logger = self._logger
+
+        def run(handle: asyncio.Handle) -> None:
+            start = perf_counter()
+            _run_handle(handle)
+            elapsed = perf_counter() - start
+
+            if elapsed >= duration:
+                slow_callbacks.inc()
+                handle._context.run(  # type: ignore[attr-defined]
+                    logger.warning, 'Blocked the event loop for %.3f seconds: %s', elapsed, describe_callback(handle)
+                )
+
+        asyncio.Handle._run = run  # type: ignore[method-assign, assignment]
+        self.reporting_slow_callbacks = True
+
+    async def aclose(self) -> None:
+        if self.reporting_slow_callbacks:
+            asyncio.Handle._run = _run_handle  # type: ignore[method-assign, assignment]
+
+        if self.loop_lag_task_ is not None:
+            self.loop_lag_task_.cancel()
+            await asyncio.gather(self.loop_lag_task_, return_exceptions=True)
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    """Stack in the collapsed format of flame graph tools, outermost frame first"""
+    names = []
+    while frame is not None:
+        names.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_qualname}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(thread_id: int, duration: float, interval: float) -> Dict[str, int]:
+    """Number of times each stack of a thread is seen, sampling it for `duration` seconds"""
+    stacks: Dict[str, int] = {}
+    end = monotonic() + duration
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id, None)
+        if frame is not None:
+            stack = collapse_stack(frame)
+            stacks[stack] = stacks.get(stack, 0) + 1
+        del frame
+        sleep(interval)
+    return stacks
+
+
+class Profiler:
+    """
+    Samples the stack of the event loop thread from another thread, for as long as asked, while serving requests
+
+    Stacks can only be sampled while the sampling thread holds the GIL, so time spent in C code that holds it
+    for long shows up as wherever the event loop releases it next, usually waiting for I/O.
+    """
+
+    def __init__(self, settings: DiagnosticsSettings, token: str) -> None:
+        self._logger = logging.getLogger('nb4mna.diagnostics')
+
+        self.settings = settings
+        self.authorization = f'Bearer {token}'
+        self.lock = asyncio.Lock()
+
+    async def profile(
+        self, seconds: float = 10.0, authorization: str = Header('')  # noqa: B008
+    ) -> PlainTextResponse:
+        """Profile in the collapsed stack format, which flame graph tools like speedscope or flamegraph.pl take"""
+        # Profiles tie up a thread and reveal the app's internals, so they're only for those holding the token
+        if not compare_digest(authorization.encode(), self.authorization.encode()):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, headers={'WWW-Authenticate': 'Bearer'})
+
+        seconds = min(max(seconds, 0.0), self.settings.profiler_max_duration)
+
+        # One profile at a time, sampling threads would only skew each other
+        async with self.lock:
+            self._logger.info('Profiling for %.1f seconds', seconds)
+            stacks = await asyncio.to_thread(
+                sample_stacks, threading.get_ident(), seconds, self.settings.profiler_interval
+            )
+
+        return PlainTextResponse(''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items())))
+
+
+def install(app: FastAPI, settings: DiagnosticsSettings) -> None:
+    """Enables diagnostics as configured, other than phase timings, which are a middleware"""
+    if settings.loop_lag_interval is not None or settings.slow_callback_duration is not None:
+        clients.register('diagnostics.loop_monitor', lambda: LoopMonitor(settings))
+
+    if settings.profiler:
+        if settings.profiler_token:
+            app.add_api_route('/debug/profile/', Profiler(settings, settings.profiler_token).profile, methods=['GET'])
+        else:
+            logging.getLogger('nb4mna.diagnostics').warning('Not serving the profiler, no profiler token set')
@@ -0,0 +1,286 @@
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+from pathlib import Path
+import sqlite3
+from time import time
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple, TypeVar
+from uuid import uuid4
+
+
+ResultT = TypeVar('ResultT')
+
+
+class DiskCacheEntry(NamedTuple):
+    value: bytes
+    time: float
+    expires: float
+
+
+class CacheBackend(ABC):
+    """
+    Storage for cached responses beyond a transport's own memory
+
+    Backends shared by several processes also coordinate requests in flight:
+    only the process holding the lease for a key fetches it, the others wait for its response to be stored.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[DiskCacheEntry]:
+        """The entry stored for `key`, None if there's none or it's expired"""
+
+    @abstractmethod
+    def put(self, key: str, entry: DiskCacheEntry) -> None:
+        """Stores an entry, without waiting for it"""
+
+    async def acquire_lease(self, key: str, duration: float) -> bool:
+        """Claims fetching `key` for `duration` seconds, False if somebody else already has"""
+        return True
+
+    def release_lease(self, key: str) -> None:  # noqa: B027
+        """Gives up a lease, once the entry it was for has been stored, or couldn't be"""
+
+    async def aclose(self) -> None:  # noqa: B027
+        pass
+
+
+class SQLiteCacheTier(CacheBackend):
+    """
+    Second cache tier in an SQLite database, which outlives the process
+
+    All database access happens on a single dedicated thread, so the event loop never waits for the disk:
+    lookups are awaited, writes are queued and written behind in batches.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache ('
+        ' namespace TEXT NOT NULL,'
+        ' key TEXT NOT NULL,'
+        ' value BLOB NOT NULL,'
+        ' time REAL NOT NULL,'
+        ' expires REAL NOT NULL,'
+        ' PRIMARY KEY (namespace, key)'
+        ')'
+    )
+
+    def __init__(
+        self,
+        path: Path,
+        namespace: str,
+        write_queue_size: int = 1024,
+        write_batch_size: int = 64,
+        purge_interval: float = 600.0,
+    ) -> None:
+        self._logger = logging.getLogger('nb4mna.diskcache')
+
+        self.path = path
+        self.namespace = namespace
+
+        self.write_batch_size = write_batch_size
+        self.purge_interval = purge_interval
+        self.write_queue: asyncio.Queue[Tuple[str, DiskCacheEntry]] = asyncio.Queue(maxsize=write_queue_size)
+        # Entries taken off the queue by the writer but not written yet, so that closing doesn't lose them
+        self.write_batch: List[Tuple[str, DiskCacheEntry]] = []
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nb4mna.diskcache')
+        self._connection: Optional[sqlite3.Connection] = None
+
+        self.write_task = asyncio.create_task(self.write_behind_task())
+
+    def _set_up(self, connection: sqlite3.Connection) -> None:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(self.SCHEMA)
+        connection.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                self._set_up(connection)
+            except sqlite3.Error:
+                # Try setting up again next time, e.g. if another process was holding the database locked
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, function: Callable[..., ResultT], *args: Any) -> ResultT:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _get(self, key: str) -> Optional[DiskCacheEntry]:
+        row = (
+            self._connect()
+            .execute(
+                'SELECT value, time, expires FROM cache WHERE namespace = ? AND key = ? AND expires > ?',
+                (self.namespace, key, time()),
+            )
+            .fetchone()
+        )
+        return DiskCacheEntry(*row) if row else None
+
+    def _put_many(self, items: List[Tuple[str, DiskCacheEntry]]) -> None:
+        connection = self._connect()
+        connection.executemany(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, time, expires) VALUES (?, ?, ?, ?, ?)',
+            [(self.namespace, key, entry.value, entry.time, entry.expires) for key, entry in items],
+        )
+        connection.commit()
+
+    def _purge(self) -> int:
+        connection = self._connect()
+        cursor = connection.execute('DELETE FROM cache WHERE namespace = ? AND expires <= ?', (self.namespace, time()))
+        connection.commit()
+        return cursor.rowcount
+
+    async def get(self, key: str) -> Optional[DiskCacheEntry]:
+        try:
+            return await self._run(self._get, key)
+        except sqlite3.Error as e:
+            self._logger.warning(f'{key}: failed to read from disk cache: {e!r}')
+            return None
+
+    def put(self, key: str, entry: DiskCacheEntry) -> None:
+        """Queues an entry to be written to disk, without waiting for it"""
+        try:
+            self.write_queue.put_nowait((key, entry))
+        except asyncio.QueueFull:
+            self._logger.warning(f'{key}: disk cache write queue is full, not persisting')
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def aclose(self) -> None:
+        """Writes out entries still queued, then closes the database"""
+        self.write_task.cancel()
+        await asyncio.gather(self.write_task, return_exceptions=True)
+
+        # Cancelling the writer may have dropped the batch in hand before the database thread got to it;
+        # writing it again is harmless if it did get to it
+        items, self.write_batch = self.write_batch, []
+        while not self.write_queue.empty():
+            items.append(self.write_queue.get_nowait())
+
+        try:
+            if items:
+                await self._run(self._put_many, items)
+            await self._run(self._close)
+        except sqlite3.Error as e:
+            self._logger.warning('Failed to close disk cache: %r', e)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def write_behind_task(self) -> None:
+        self._logger.debug(f'Started disk cache writer for {self.namespace!r} in {self.path}')
+
+        last_purge = 0.0
+
+        while True:
+            try:
+                items = [await asyncio.wait_for(self.write_queue.get(), timeout=self.purge_interval)]
+            except TimeoutError:
+                items = []
+
+            while items and len(items) < self.write_batch_size and not self.write_queue.empty():
+                items.append(self.write_queue.get_nowait())
+
+            self.write_batch = items
+            try:
+                if items:
+                    await self._run(self._put_many, items)
+                    self._logger.debug('Wrote %d entries to disk cache', len(items))
+                self.write_batch = []
+
+                if time() - last_purge >= self.purge_interval:
+                    purged = await self._run(self._purge)
+                    last_purge = time()
+                    if purged:
+                        self._logger.debug(f'Purged {purged} expired entries from disk cache')
+            except sqlite3.Error as e:
+                self._logger.warning(f'Failed to write to disk cache: {e!r}')
+
+
+class SharedSQLiteCacheBackend(SQLiteCacheTier):
+    """
+    Cache tier in an SQLite database shared by several processes on the same host, along with their requests in flight
+
+    Entries are written through rather than behind, so that other processes see them right away.
+    Leases are released only after the writes queued before them, so waiters find the entry once the lease is gone.
+    """
+
+    LEASES_SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS leases ('
+        ' namespace TEXT NOT NULL,'
+        ' key TEXT NOT NULL,'
+        ' owner TEXT NOT NULL,'
+        ' expires REAL NOT NULL,'
+        ' PRIMARY KEY (namespace, key)'
+        ')'
+    )
+
+    def __init__(self, path: Path, namespace: str, **kwargs: Any) -> None:
+        super().__init__(path, namespace, **kwargs)
+        self.owner = uuid4().hex
+
+    def _set_up(self, connection: sqlite3.Connection) -> None:
+        super()._set_up(connection)
+        connection.execute(self.LEASES_SCHEMA)
+        connection.commit()
+
+    def _submit(self, function: Callable[..., Any], *args: Any) -> None:
+        """Runs `function` on the database thread, after everything submitted before it, without waiting for it"""
+        self._executor.submit(function, *args).add_done_callback(self._log_failure)
+
+    def _log_failure(self, future: 'Future[Any]') -> None:
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.warning('Failed to write to shared cache: %r', future.exception())
+
+    def _acquire_lease(self, key: str, duration: float) -> bool:
+        now = time()
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM leases WHERE namespace = ? AND key = ? AND expires <= ?',
+                (self.namespace, key, now),
+            )
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO leases (namespace, key, owner, expires) VALUES (?, ?, ?, ?)',
+                (self.namespace, key, self.owner, now + duration),
+            )
+        return cursor.rowcount == 1
+
+    def _release_lease(self, key: str) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM leases WHERE namespace = ? AND key = ? AND owner = ?',
+                (self.namespace, key, self.owner),
+            )
+
+    def _release_leases(self) -> None:
+        with self._connect() as connection:
+            connection.execute('DELETE FROM leases WHERE owner = ?', (self.owner,))
+
+    def put(self, key: str, entry: DiskCacheEntry) -> None:
+        self._submit(self._put_many, [(key, entry)])
+
+    async def acquire_lease(self, key: str, duration: float) -> bool:
+        try:
+            return await self._run(self._acquire_lease, key, duration)
+        except sqlite3.Error as e:
+            # Better to fetch twice than not at all
+            self._logger.warning('%s: failed to acquire lease: %r', key, e)
+            return True
+
+    def release_lease(self, key: str) -> None:  # noqa: B027
+        self._submit(self._release_lease, key)
+
+    async def aclose(self) -> None:
+        try:
+            await self._run(self._release_leases)
+        except sqlite3.Error as e:
+            self._logger.warning('Failed to release leases: %r', e)
+
+        await super().aclose()
@@ -1,7 +1,65 @@
+import atexit
+import logging
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
 
+from pydantic import BaseModel
+
+
+class LoggingSettings(BaseModel):
+    level: str = 'DEBUG'
+    httpx_level: str = 'DEBUG'
+    uvicorn_level: str = 'INFO'
+    # Hand log records over to a background thread, so that writing them out never blocks the event loop
+    queue: bool = False
+
+
+_queue_listener: Optional[QueueListener] = None
+
+
+def _stop_queue_listener() -> None:
+    global _queue_listener
+
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def configure_logging(settings: Optional[LoggingSettings] = None) -> None:
+    settings = settings or LoggingSettings()
+
+    _stop_queue_listener()
+
+    handlers: Dict[str, Dict[str, Any]] = {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['correlation_id'],
+            'formatter': 'console',
+        },
+        'console_brief': {
+            'class': 'logging.StreamHandler',
+            'filters': ['correlation_id'],
+            'formatter': 'console_brief',
+        },
+    }
+    handler = 'console_brief'
+
+    if settings.queue:
+        # The correlation ID is only known in the request's context, not in the logging thread,
+        # so it's filtered in before queueing
+        handlers['console_brief_queued'] = {
+            'class': 'logging.StreamHandler',
+            'formatter': 'console_brief',
+        }
+        handlers['queue'] = {
+            'class': 'logging.handlers.QueueHandler',
+            'filters': ['correlation_id'],
+            'handlers': ['console_brief_queued'],
+            'respect_handler_level': True,
+        }
+        handler = 'queue'
 
-def configure_logging() -> None:
     dictConfig(
         {
             'version': 1,
@@ -26,22 +84,22 @@ def configure_logging() -> None:
                     'format': '%(levelname)3s:\t%(asctime)s [%(correlation_id)s] %(name)s: %(message)s',
                 },
             },
-            'handlers': {
-                'console': {
-                    'class': 'logging.StreamHandler',
-                    'filters': ['correlation_id'],
-                    'formatter': 'console',
-                },
-                'console_brief': {
-                    'class': 'logging.StreamHandler',
-                    'filters': ['correlation_id'],
-                    'formatter': 'console_brief',
-                },
-            },
+            'handlers': handlers,
             'loggers': {
-                'nb4mna': {'handlers': ['console_brief'], 'level': 'DEBUG'},
-                'httpx': {'handlers': ['console_brief'], 'level': 'DEBUG'},
-                'uvicorn': {'handlers': ['console_brief'], 'level': 'INFO'},
+                'nb4mna': {'handlers': [handler], 'level': settings.level},
+                'httpx': {'handlers': [handler], 'level': settings.httpx_level},
+                'uvicorn': {'handlers': [handler], 'level': settings.uvicorn_level},
             },
         }
     )
+
+    if settings.queue:
+        global _queue_listener
+
+        queue_handler = logging.getHandlerByName('queue')
+        assert isinstance(queue_handler, QueueHandler)  # noqa: S101
+        _queue_listener = queue_handler.listener
+
+        if _queue_listener is not None:
+            _queue_listener.start()
+            atexit.register(_stop_queue_listener)
@@ -0,0 +1,177 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# Labels are kept as sorted tuples of (name, value) pairs, so that they can be dictionary keys
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def make_labels(**labels: str) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_sample(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        labels_f = ','.join('{}="{}"'.format(key, escape_label_value(label)) for key, label in labels)
+        return f'{name}{{{labels_f}}} {value!r}'
+    return f'{name} {value!r}'
+
+
+class Metric(ABC):
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        """Lines of the metric's samples in the Prometheus text format"""
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = make_labels(**labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield format_sample(self.name, labels, value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # Per labels: observation count per bucket (the last one being +Inf), and the sum of observations
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = make_labels(**labels)
+        counts = self.counts.get(key, None)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts, strict=True):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield format_sample(f'{self.name}_bucket', (*labels, ('le', le)), cumulative)
+            yield format_sample(f'{self.name}_count', labels, cumulative)
+            yield format_sample(f'{self.name}_sum', labels, self.sums[labels])
+
+
+class CallbackMetric(Metric):
+    """Metric whose values are collected from elsewhere at the time of rendering"""
+
+    def __init__(
+        self, name: str, documentation: str, metric_type: str, collect: Callable[[], Iterable[Tuple[Labels, float]]]
+    ) -> None:
+        super().__init__(name, documentation)
+        self.type = metric_type
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.collect():
+            yield format_sample(self.name, labels, value)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name!r} is already registered')
+        self.metrics[metric.name] = metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self.register(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, buckets)
+        self.register(metric)
+        return metric
+
+    def callback(
+        self, name: str, documentation: str, metric_type: str, collect: Callable[[], Iterable[Tuple[Labels, float]]]
+    ) -> CallbackMetric:
+        metric = CallbackMetric(name, documentation, metric_type, collect)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        """Renders all metrics in Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+registry = Registry()
+
+
+request_duration = registry.histogram(
+    'nb4mna_request_duration_seconds',
+    'Time taken to handle incoming requests, per route',
+)
+
+
+class RequestDurationMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the same scope
+            route = scope.get('route', None)
+            request_duration.observe(
+                perf_counter() - start,
+                route=getattr(route, 'path', 'unmatched'),
+                method=scope['method'],
+                status=str(status),
+            )
@@ -4,16 +4,23 @@ from importlib import resources
 import logging
 from random import choice, randint
 import re
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter, FastAPI, Request
 from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
 import yaml
 
+from .tenants import TatsumakiTenants
 from ...api.nightbot import NightbotData, NightbotDepends
-from ...api.tatsumaki import TatsumakiAPI, TatsumakiAPIException
+from ...api.tatsumaki import TatsumakiAPIException
+from ...clients import clients, create_http_client
+from ...deadlines import deadline
+from ...phases import phase
+from ...replies import deferred_replies
+from ...scheduling import UpstreamScheduler
 from ...settings import settings
+from ...throttling import CommandSlot, ThrottlingDepends
 
 
 DISCORD_USER_ID_REGEX = re.compile(r'(?<=<@)\d+(?=>)')
@@ -43,10 +50,22 @@ class Phrases(BaseModel):
 router = APIRouter(prefix='/fight')
 
 _logger = logging.getLogger('nb4mna.modules.fight')
-_tatsumaki = TatsumakiAPI(
-    api_key=settings.tatsumaki.api_key,
-    guild_id=settings.tatsumaki.guild_id,
-)
+
+
+def _create_tatsumaki_tenants() -> TatsumakiTenants:
+    return TatsumakiTenants(
+        client=create_http_client(
+            'tatsumaki',
+            settings.http,
+            settings.tatsumaki.cache,
+            settings.cache,
+            scheduler=UpstreamScheduler('tatsumaki', settings.tatsumaki.upstream),
+        ),
+        settings=settings.tatsumaki,
+    )
+
+
+_tatsumaki_tenants = clients.register('tatsumaki', _create_tatsumaki_tenants)
 
 with resources.open_binary(__package__, 'phrases.yaml') as f:
     phrases = Phrases(**yaml.safe_load(f))
@@ -79,8 +98,9 @@ async def fight_discord(nightbot: NightbotData, message: str) -> FightInput:
         source_probability = 1
         target_probability = 1
     else:
-        source_probability_task = create_task(_tatsumaki.get_guild_member_ranking(source_user_id))
-        target_probability_task = create_task(_tatsumaki.get_guild_member_ranking(target_user_id))
+        tatsumaki = _tatsumaki_tenants.get().get(nightbot.channel)
+        source_probability_task = create_task(tatsumaki.get_guild_member_ranking(source_user_id))
+        target_probability_task = create_task(tatsumaki.get_guild_member_ranking(target_user_id))
         source_probability = (await source_probability_task).score
         target_probability = (await target_probability_task).score
 
@@ -111,10 +131,7 @@ async def fight_twitch(nightbot: NightbotData, message: str) -> FightInput:
     )
 
 
-@router.get('/')
-async def fight(message: str, nightbot: NightbotData = NightbotDepends) -> PlainTextResponse:
-    _logger.debug(f'{message[:40]=}')
-
+async def get_message(nightbot: NightbotData, message: str) -> str:
     try:
         if nightbot.user.provider == 'discord':
             fight_input = await fight_discord(nightbot, message)
@@ -124,28 +141,35 @@ async def fight(message: str, nightbot: NightbotData = NightbotDepends) -> Plain
             raise ValueError('Unsupported provider')
     except ValueError as e:
         _logger.error(e)
-        return PlainTextResponse(str(e))
+        return str(e)
 
     _logger.info(
-        f'{fight_input.source_user=} {fight_input.source_probability=}'
-        f' {fight_input.target_user=} {fight_input.target_probability=}'
+        'fight_input.source_user=%r fight_input.source_probability=%r'
+        ' fight_input.target_user=%r fight_input.target_probability=%r',
+        fight_input.source_user,
+        fight_input.source_probability,
+        fight_input.target_user,
+        fight_input.target_probability,
     )
 
+    with phase('render'):
+        return render_fight(fight_input)
+
+
+def render_fight(fight_input: FightInput) -> str:
     if fight_input.source_user == fight_input.target_user:
-        return PlainTextResponse(
+        return (
             f'{fight_input.source_user} fought with themselves and are now in a state of quantum superposition.'
         )
 
     if fight_input.source_probability == 0:
-        return PlainTextResponse(
+        return (
             f"{fight_input.source_user}, you're not in the leaderboard just yet,"
             " get some more XP and try fighting again later."
         )
 
     if fight_input.target_probability == 0:
-        return PlainTextResponse(
-            f"{fight_input.source_user}, you can't fight somebody with no experience at all. Shame on you!"
-        )
+        return f"{fight_input.source_user}, you can't fight somebody with no experience at all. Shame on you!"
 
     result = randint(1, fight_input.source_probability + fight_input.target_probability)
     probability = fight_input.source_probability / (fight_input.source_probability + fight_input.target_probability)
@@ -155,17 +179,59 @@ async def fight(message: str, nightbot: NightbotData = NightbotDepends) -> Plain
     weapon = choice(phrases.weapons)
     conclusion = choice(phrases.win) + '!' if is_win else choice(phrases.loss) + '.'
 
-    _logger.info(f'{result=} {is_win=}')
+    _logger.info('result=%r is_win=%r', result, is_win)
 
-    return PlainTextResponse(
+    return (
         f'{fight_input.source_user} {verb} {fight_input.target_user}'
         f' with {weapon} and {conclusion}'
         f' ({probability:.01%} win chance)'
     )
 
 
+@router.get('/')
+async def fight(
+    message: str,
+    nightbot: NightbotData = NightbotDepends,
+    slot: CommandSlot = ThrottlingDepends,
+) -> PlainTextResponse:
+    _logger.debug('message[:40]=%r', message[:40])
+    with deadline(settings.deadlines.fight):
+        # A deferred reply keeps the command's slot until it's been sent
+        reply = await deferred_replies.get().reply(
+            nightbot, get_message(nightbot, message), _render_exception, release=slot.hand_over()
+        )
+    return PlainTextResponse(reply)
+
+
+async def warm_up() -> None:
+    """Opens the connection to Tatsumaki and preloads member rankings of the default guild, as configured"""
+    tatsumaki = _tatsumaki_tenants.get().default
+
+    if settings.warmup.keepalive_interval is not None:
+        tatsumaki.keep_connection_alive(settings.warmup.keepalive_interval)
+
+    if settings.warmup.prewarm_connections:
+        await tatsumaki.prewarm()
+
+    if settings.tatsumaki.preload_top_members or settings.tatsumaki.preload_user_ids:
+        try:
+            await tatsumaki.preload(
+                top_members=settings.tatsumaki.preload_top_members,
+                user_ids=settings.tatsumaki.preload_user_ids,
+            )
+        except Exception as e:
+            # Preloading is only an optimisation, it shouldn't keep the app from starting
+            _logger.warning('Failed to preload member rankings: %r', e)
+
+
+def _render_exception(exc: Exception) -> Optional[str]:
+    if isinstance(exc, TatsumakiAPIException):
+        return f'Tatsumaki API error: {exc}'
+    return None
+
+
 def _api_exception_handler(request: Request, exc: Exception) -> Response:
-    return PlainTextResponse(f'Tatsumaki API error: {exc}')
+    return PlainTextResponse(_render_exception(exc))
 
 
 def install(app: FastAPI) -> None:
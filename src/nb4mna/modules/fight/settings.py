@@ -1,6 +1,41 @@
+from typing import Dict, List, Optional
+
 from pydantic import BaseModel
 
+from ...clients import HTTPCacheSettings
+from ...scheduling import UpstreamSettings
+
+
+class TatsumakiGuildSettings(BaseModel):
+    guild_id: int
+    # Defaults to the API key of the default guild
+    api_key: Optional[str] = None
+
+    leaderboard_refresh_interval: Optional[float] = None
+
 
 class TatsumakiSettings(BaseModel):
     api_key: str
     guild_id: int
+
+    cache: HTTPCacheSettings = HTTPCacheSettings()
+
+    # Tatsu allows 60 requests per minute per API key
+    upstream: UpstreamSettings = UpstreamSettings(rate_limit=1.0, rate_limit_burst=60)
+
+    # Fetch the whole guild leaderboard in bulk this often, and serve member rankings from it
+    leaderboard_refresh_interval: Optional[float] = None
+    leaderboard_max_pages: int = 50
+
+    # Member rankings to cache at startup: the top members of the guild, and specific users
+    preload_top_members: int = 0
+    preload_user_ids: List[int] = []
+
+    # Guilds of Nightbot channels, by the channel's provider ID, other channels getting the guild above;
+    # all guilds share the connection pool, upstream rate limit and member ranking cache
+    guilds: Dict[str, TatsumakiGuildSettings] = {}
+    # Clients of guilds other than the one above are closed once unused for this long
+    guild_idle_timeout: float = 3600.0
+    # Member rankings cached at most, across guilds
+    member_ranking_cache_max_entries: int = 1024
+    member_ranking_cache_max_size: Optional[int] = None
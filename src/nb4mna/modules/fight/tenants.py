@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from .settings import TatsumakiSettings
+from ...api.nightbot import NightbotChannel
+from ...api.tatsumaki import MemberRanking, TatsumakiAPI
+from ...caching import ResultCache
+
+
+class TatsumakiTenants:
+    """
+    Tatsumaki clients per guild, picked by the Nightbot channel commands come from
+
+    The client of the default guild always exists, those of other guilds are created on first use
+    and stopped once idle for a while. They all share one HTTP client, and with it the connection pool,
+    response cache and upstream scheduler, as well as one member ranking cache,
+    so serving another guild costs little more than the rankings cached for it.
+    """
+
+    # Seconds between looking for idle clients
+    EVICTION_INTERVAL = 60.0
+
+    def __init__(self, client: httpx.AsyncClient, settings: TatsumakiSettings) -> None:
+        self._logger = logging.getLogger('nb4mna.modules.fight.tenants')
+
+        self.client = client
+        self.settings = settings
+
+        self.member_ranking_cache: ResultCache[Tuple[int, int], MemberRanking] = ResultCache(
+            duration=settings.cache.duration,
+            max_entries=settings.member_ranking_cache_max_entries,
+            max_size=settings.member_ranking_cache_max_size,
+            name='tatsumaki.member_ranking',
+        )
+
+        self.default = self._create_tatsumaki(
+            settings.guild_id, settings.api_key, settings.leaderboard_refresh_interval
+        )
+
+        # Clients of guilds other than the default one, along with when they were last used
+        self.guilds: Dict[int, TatsumakiAPI] = {}
+        self.last_used: Dict[int, float] = {}
+
+        self.eviction_task: Optional[asyncio.Task[None]] = None
+        if settings.guilds:
+            self.eviction_task = asyncio.create_task(self.evict_idle_task())
+
+    def _create_tatsumaki(
+        self, guild_id: int, api_key: str, leaderboard_refresh_interval: Optional[float]
+    ) -> TatsumakiAPI:
+        return TatsumakiAPI(
+            client=self.client,
+            api_key=api_key,
+            guild_id=guild_id,
+            cache_duration=self.settings.cache.duration,
+            leaderboard_refresh_interval=leaderboard_refresh_interval,
+            leaderboard_max_pages=self.settings.leaderboard_max_pages,
+            member_ranking_cache=self.member_ranking_cache,
+        )
+
+    def get(self, channel: NightbotChannel) -> TatsumakiAPI:
+        """Client of the guild of a channel, the default one if the channel has none configured"""
+        guild = self.settings.guilds.get(channel.providerId, None)
+        if guild is None or guild.guild_id == self.default.guild_id:
+            return self.default
+
+        tatsumaki = self.guilds.get(guild.guild_id, None)
+        if tatsumaki is None:
+            self._logger.info('Starting client for guild %d', guild.guild_id)
+            tatsumaki = self.guilds[guild.guild_id] = self._create_tatsumaki(
+                guild.guild_id, guild.api_key or self.settings.api_key, guild.leaderboard_refresh_interval
+            )
+
+        self.last_used[guild.guild_id] = monotonic()
+        return tatsumaki
+
+    async def evict_idle(self) -> None:
+        now = monotonic()
+        idle = [
+            guild_id
+            for guild_id, last_used in self.last_used.items()
+            if now - last_used >= self.settings.guild_idle_timeout
+        ]
+
+        for guild_id in idle:
+            # Requests still using the client can finish, only its background tasks are stopped
+            tatsumaki = self.guilds.pop(guild_id)
+            del self.last_used[guild_id]
+            await tatsumaki.stop()
+            self._logger.info('Stopped idle client for guild %d', guild_id)
+
+    async def evict_idle_task(self) -> None:
+        while True:
+            await asyncio.sleep(self.EVICTION_INTERVAL)
+            await self.evict_idle()
+
+    async def aclose(self) -> None:
+        if self.eviction_task is not None:
+            self.eviction_task.cancel()
+            await asyncio.gather(self.eviction_task, return_exceptions=True)
+
+        await asyncio.gather(*(tatsumaki.stop() for tatsumaki in self.guilds.values()))
+        self.guilds.clear()
+        self.last_used.clear()
+
+        # Closes the shared HTTP client as well
+        await self.default.aclose()
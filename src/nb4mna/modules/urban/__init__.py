@@ -1,48 +1,143 @@
+import asyncio
 import logging
 import re
+from typing import Optional
 
 from fastapi import APIRouter, FastAPI, Request
 from fastapi.responses import PlainTextResponse, Response
 
-from ...api.nightbot import MAX_MESSAGE_LENGTH
-from ...api.urbandictionary import TermDefinition, UrbanDictionaryAPI, UrbanDictionaryAPIException
+from .termindex import TermIndex
+from ...api.nightbot import MAX_MESSAGE_LENGTH, NightbotData, NightbotOptionalDepends
+from ...api.urbandictionary import TermDefinition, TermDefinitions, UrbanDictionaryAPI, UrbanDictionaryAPIException
+from ...caching import ResultCache
+from ...clients import clients, create_http_client
+from ...deadlines import deadline
+from ...phases import phase
+from ...replies import deferred_replies
+from ...scheduling import UpstreamScheduler
+from ...settings import settings
+from ...throttling import CommandSlot, ThrottlingDepends
 
 
 URBANDICTIONARY_REGEX = re.compile(r'\[(.+?)]')
 
+# Replies for terms without definitions, cached as is and filled in with the term as asked for each time,
+# since replies are shared by every case of a term
+NO_DEFINITIONS = 'No definitions found for {term!r}'
+NO_DEFINITIONS_API_BUG = 'No definitions found for {term!r} (API bug?)'
+
 router = APIRouter(prefix='/urban')
 
 _logger = logging.getLogger('nb4mna.modules.urban')
-_urbandictionary = UrbanDictionaryAPI()
 
 
-@router.get('/')
-async def urban(term: str) -> PlainTextResponse:
-    _logger.debug(f'{term=}')
-
-    autocomplete = await _urbandictionary.get_autocomplete(term)
-    if not autocomplete.list:
-        return PlainTextResponse(f'No definitions found for {term!r}')
-    _logger.debug(f'Autocomplete: {autocomplete.list}')
-
-    # Urban Dictionary's API is a hot mess
-    # For example, for term "spam" it returns
-    # ['Sam', 'Samantha', 'Samuel', 'SPAM', ...]
-    # The exact matching term is not first, so we try to find one ourselves in the suggested list
-    try:
-        term_autocompleted = next(t for t in autocomplete.list if term.lower() == t.lower())
-    except StopIteration:
-        term_autocompleted = autocomplete.list[0]
+def _create_urbandictionary() -> UrbanDictionaryAPI:
+    return UrbanDictionaryAPI(
+        client=create_http_client(
+            'urbandictionary',
+            settings.http,
+            settings.urban.cache,
+            settings.cache,
+            scheduler=UpstreamScheduler('urbandictionary', settings.urban.upstream),
+        ),
+        cache_duration=settings.urban.cache.duration,
+        cache_max_entries=settings.urban.result_cache_max_entries,
+        cache_max_size=settings.urban.result_cache_max_size,
+    )
+
+
+def _create_term_index() -> TermIndex:
+    assert settings.urban.term_index_path is not None  # noqa: S101
+    return TermIndex(settings.urban.term_index_path, max_terms=settings.urban.term_index_max_terms)
+
+
+_urbandictionary = clients.register('urbandictionary', _create_urbandictionary)
+_term_index = clients.register('urban.term_index', _create_term_index) if settings.urban.term_index_path else None
+_response_cache: ResultCache[str, str] = ResultCache(
+    duration=settings.urban.response_cache_duration,
+    max_entries=settings.urban.response_cache_max_entries,
+    max_size=settings.urban.response_cache_max_size,
+    name='urban.response',
+)
+
 
-    if term != term_autocompleted:
-        _logger.debug(f"Autocompleted term {term!r} to {term_autocompleted!r}")
+def _get_term_index() -> Optional[TermIndex]:
+    return _term_index.get() if _term_index is not None else None
+
+
+def _retrieve_exception(task: asyncio.Task[TermDefinitions]) -> None:
+    # Keeps a failed speculative request that ends up unused from being reported as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+async def autocomplete_and_get_term(term: str) -> Optional[TermDefinitions]:
+    """Definitions of the best match for a term among its autocompletions, None if there are none"""
+    # Most of the time the term is autocompleted to itself, so its definition may as well be requested right away
+    speculative_terms = None
+    if settings.urban.speculative_define:
+        speculative_terms = asyncio.create_task(_urbandictionary.get().get_term(term))
+        speculative_terms.add_done_callback(_retrieve_exception)
+
+    try:
+        autocomplete = await _urbandictionary.get().get_autocomplete(term)
+        if not autocomplete.list:
+            return None
+        _logger.debug('Autocomplete: %s', autocomplete.list)
+
+        term_index = _get_term_index()
+        if term_index is not None:
+            for t in autocomplete.list:
+                term_index.add(t)
+
+        # Urban Dictionary's API is a hot mess
+        # For example, for term "spam" it returns
+        # ['Sam', 'Samantha', 'Samuel', 'SPAM', ...]
+        # The exact matching term is not first, so we try to find one ourselves in the suggested list
+        try:
+            term_autocompleted = next(t for t in autocomplete.list if term.lower() == t.lower())
+        except StopIteration:
+            term_autocompleted = autocomplete.list[0]
+
+        if term != term_autocompleted:
+            _logger.debug('Autocompleted term %r to %r', term, term_autocompleted)
+
+        if speculative_terms is not None and term == term_autocompleted:
+            return await speculative_terms
+        return await _urbandictionary.get().get_term(term_autocompleted)
+    finally:
+        # No-op if the speculative request was used
+        if speculative_terms is not None:
+            speculative_terms.cancel()
+
+
+async def define(term: str) -> str:
+    """Looks up a term and renders its definition as a chat message, or one of the replies for no definitions"""
+    term_index = _get_term_index()
+    term_indexed = term_index.get(term) if term_index is not None else None
+
+    if term_indexed is not None:
+        _logger.debug('Found term %r in index as %r', term, term_indexed)
+        terms: Optional[TermDefinitions] = await _urbandictionary.get().get_term(term_indexed)
+    else:
+        terms = await autocomplete_and_get_term(term)
+
+    if terms is None:
+        return NO_DEFINITIONS
 
-    terms = await _urbandictionary.get_term(term_autocompleted)
     if not terms.list:
-        return PlainTextResponse(f'No definitions found for {term!r} (API bug?)')
+        return NO_DEFINITIONS_API_BUG
 
     term_definition: TermDefinition = terms.list[0]
 
+    if term_index is not None:
+        term_index.add(term_definition.word)
+
+    with phase('render'):
+        return render_definition(term_definition)
+
+
+def render_definition(term_definition: TermDefinition) -> str:
     word_f = f'**{term_definition.word}.** '
     url_f = f' {term_definition.permalink}'
 
@@ -54,11 +149,65 @@ async def urban(term: str) -> PlainTextResponse:
     if len(definition) > max_definition_length:
         definition = definition[: max_definition_length - 1] + '…'
 
-    return PlainTextResponse(f'{word_f}{definition}{url_f}')
+    return f'{word_f}{definition}{url_f}'
+
+
+async def get_message(term: str) -> str:
+    key = term.casefold()
+    with phase('cache'):
+        message = _response_cache.get(key)
+
+    if message is None:
+        message = await define(term)
+        _response_cache.put(key, message)
+
+    if message in (NO_DEFINITIONS, NO_DEFINITIONS_API_BUG):
+        return message.format(term=term)
+    return message
+
+
+@router.get('/')
+async def urban(
+    term: str,
+    nightbot: Optional[NightbotData] = NightbotOptionalDepends,
+    slot: CommandSlot = ThrottlingDepends,
+) -> PlainTextResponse:
+    _logger.debug('term=%r', term)
+    with deadline(settings.deadlines.urban):
+        # A deferred reply keeps the command's slot until it's been sent
+        reply = await deferred_replies.get().reply(
+            nightbot, get_message(term), _render_exception, release=slot.hand_over()
+        )
+    return PlainTextResponse(reply)
+
+
+async def warm_up() -> None:
+    """Opens the connection to Urban Dictionary and looks up terms to preload, as configured"""
+    urbandictionary = _urbandictionary.get()
+
+    if settings.warmup.keepalive_interval is not None:
+        urbandictionary.keep_connection_alive(settings.warmup.keepalive_interval)
+
+    if settings.warmup.prewarm_connections:
+        await urbandictionary.prewarm()
+
+    preloads = (get_message(term) for term in settings.urban.preload_terms)
+    results = await asyncio.gather(*preloads, return_exceptions=True)
+    failures = [e for e in results if isinstance(e, Exception)]
+    if failures:
+        _logger.warning('Failed to preload %d of %d terms: %r', len(failures), len(results), failures[0])
+    elif results:
+        _logger.info('Preloaded %d terms', len(results))
+
+
+def _render_exception(exc: Exception) -> Optional[str]:
+    if isinstance(exc, UrbanDictionaryAPIException):
+        return f'Urban Dictionary API error: {exc}'
+    return None
 
 
 def _api_exception_handler(request: Request, exc: Exception) -> Response:
-    return PlainTextResponse(f'Urban Dictionary API error: {exc}')
+    return PlainTextResponse(_render_exception(exc))
 
 
 def install(app: FastAPI) -> None:
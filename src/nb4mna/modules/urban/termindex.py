@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class TermIndex:
+    """
+    Terms known to Urban Dictionary by their case-folded form, so that exact matches resolve without autocompletion
+
+    Kept in memory and persisted to a text file, one term per line.
+    New terms are appended to it in batches by a background task, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path: Path, max_terms: int = 100_000, write_interval: float = 10.0) -> None:
+        self._logger = logging.getLogger('nb4mna.modules.urban.termindex')
+
+        self.path = path
+        self.max_terms = max_terms
+        self.write_interval = write_interval
+
+        self.terms: Dict[str, str] = {}
+        self.pending: List[str] = []
+
+        self.load()
+        self.write_task = asyncio.create_task(self.write_behind_task())
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def load(self) -> None:
+        try:
+            # Only '\n' separates terms, others such as '\r' may be part of them
+            with self.path.open(encoding='utf-8', newline='\n') as f:
+                for line in f:
+                    self._add(line.rstrip('\n'))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._logger.warning('Failed to load term index from %s: %r', self.path, e)
+            return
+
+        self._logger.info('Loaded %d terms from %s', len(self.terms), self.path)
+
+    def _add(self, term: str) -> bool:
+        if not term.strip() or '\n' in term or len(self.terms) >= self.max_terms:
+            return False
+
+        key = term.casefold()
+        if key in self.terms:
+            return False
+
+        self.terms[key] = term
+        return True
+
+    def add(self, term: str) -> None:
+        if self._add(term):
+            self.pending.append(term)
+
+    def get(self, term: str) -> Optional[str]:
+        """Known term matching `term` case-insensitively, if any"""
+        return self.terms.get(term.casefold(), None)
+
+    def _write(self, terms: List[str]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a', encoding='utf-8', newline='\n') as f:
+            f.writelines(f'{term}\n' for term in terms)
+
+    async def write_pending(self) -> None:
+        if not self.pending:
+            return
+
+        terms, self.pending = self.pending, []
+        try:
+            await asyncio.to_thread(self._write, terms)
+            self._logger.debug('Wrote %d new terms to term index', len(terms))
+        except OSError as e:
+            self._logger.warning('Failed to write to term index: %r', e)
+
+    async def write_behind_task(self) -> None:
+        while True:
+            await asyncio.sleep(self.write_interval)
+            await self.write_pending()
+
+    async def aclose(self) -> None:
+        """Stops the background task and writes out terms still pending"""
+        self.write_task.cancel()
+        await asyncio.gather(self.write_task, return_exceptions=True)
+        await self.write_pending()
@@ -0,0 +1,84 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import logging
+from time import perf_counter
+from typing import ContextManager, Dict, Iterator, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .metrics import registry
+
+
+request_phase_duration = registry.histogram(
+    'nb4mna_request_phase_duration_seconds',
+    'Time taken by each phase of handling incoming requests, per route',
+)
+
+
+class PhaseTimings:
+    """Time spent in each phase of handling a request, phases being timed again adding up"""
+
+    def __init__(self, scope: Scope) -> None:
+        self.scope = scope
+        self.durations: Dict[str, float] = {}
+
+    @property
+    def route(self) -> str:
+        # The router stores the matched route in the same scope
+        return getattr(self.scope.get('route', None), 'path', 'unmatched')
+
+    def add(self, phase: str, duration: float) -> None:
+        self.durations[phase] = self.durations.get(phase, 0.0) + duration
+        request_phase_duration.observe(duration, route=self.route, phase=phase)
+
+
+# Timings of the request being handled, only set while phase timings are enabled
+_timings: ContextVar[Optional[PhaseTimings]] = ContextVar('nb4mna.phase_timings', default=None)
+
+_untimed = nullcontext()
+
+
+@contextmanager
+def _timed(timings: PhaseTimings, name: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - start)
+
+
+def phase(name: str) -> ContextManager[None]:
+    """Times what's within as phase `name` of the request being handled, if phase timings are enabled"""
+    timings = _timings.get()
+    if timings is None:
+        return _untimed
+    return _timed(timings, name)
+
+
+class PhaseTimingMiddleware:
+    """Enables phase timings for each request, logging them once it's been handled"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self._logger = logging.getLogger('nb4mna.phases')
+
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timings = PhaseTimings(scope)
+        token = _timings.set(timings)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _timings.reset(token)
+
+        # Phases of deferred replies finishing later are only recorded in the metric
+        if timings.durations:
+            self._logger.info(
+                'Phase timings for %s: %s',
+                timings.route,
+                ' '.join(f'{name}={duration * 1000:.1f}ms' for name, duration in timings.durations.items()),
+            )
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import httpx
+from pydantic import HttpUrl
+
+from .api.nightbot import NightbotAPI, NightbotData
+from .clients import clients
+from .settings import DeferredReplySettings, settings
+
+
+# Renders an exception raised while preparing a message as a message, None if nothing should be sent
+ExceptionRenderer = Callable[[Exception], Optional[str]]
+
+
+class DeferredReplies:
+    """
+    Replies to Nightbot commands either right away, or through their response URL once the message is ready
+
+    Messages are prepared in tasks, which keep running after their request has been replied to.
+    Finished messages are queued, and sent by a fixed number of background tasks.
+    """
+
+    def __init__(self, nightbot: NightbotAPI, settings: DeferredReplySettings) -> None:
+        self._logger = logging.getLogger('nb4mna.replies')
+
+        self.nightbot = nightbot
+        self.settings = settings
+        self.response_url_origins = {(url.scheme, url.host, url.port) for url in settings.response_url_origins}
+
+        # Messages deferred, until they're sent
+        self.pending: Set[asyncio.Task[str]] = set()
+        # Called once deferred messages have been sent, or dropped
+        self.release_callbacks: Dict[asyncio.Task[str], Callable[[], None]] = {}
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        self.queue: asyncio.Queue[Tuple[asyncio.Task[str], HttpUrl, str]] = asyncio.Queue()
+        self.send_tasks = [asyncio.create_task(self.send_task()) for _ in range(settings.max_concurrent_sends)]
+
+    def is_response_url_allowed(self, response_url: HttpUrl) -> bool:
+        return (response_url.scheme, response_url.host, response_url.port) in self.response_url_origins
+
+    async def reply(
+        self,
+        nightbot: Optional[NightbotData],
+        message: Awaitable[str],
+        render_exception: ExceptionRenderer,
+        release: Optional[Callable[[], None]] = None,
+    ) -> str:
+        """
+        Message to reply with, or the placeholder if it's not ready within the budget,
+        in which case the message is sent through the response URL once it is
+
+        Exceptions raised while preparing the message propagate as usual, unless it's been deferred.
+        Messages for response URLs not pointing at Nightbot are never deferred.
+        `release` is called once the message is done with: on return, or once the deferred reply has been sent.
+        """
+        deferred = False
+        try:
+            if nightbot is None or not self.settings.enabled or len(self.pending) >= self.settings.max_pending:
+                return await message
+
+            if not self.is_response_url_allowed(nightbot.response_url):
+                self._logger.debug('Response URL %s not allowed, not deferring reply', nightbot.response_url)
+                return await message
+
+            task = asyncio.ensure_future(message)
+            try:
+                done, _ = await asyncio.wait({task}, timeout=self.settings.budget)
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            if done:
+                return task.result()
+
+            self._logger.info('Message not ready in %.1f seconds, deferring reply', self.settings.budget)
+            deferred = True
+            self.pending.add(task)
+            self.idle.clear()
+            if release is not None:
+                self.release_callbacks[task] = release
+            response_url = nightbot.response_url
+            task.add_done_callback(lambda t: self._prepared(t, response_url, render_exception))
+            return self.settings.placeholder
+        finally:
+            if release is not None and not deferred:
+                release()
+
+    def _prepared(self, task: asyncio.Task[str], response_url: HttpUrl, render_exception: ExceptionRenderer) -> None:
+        message: Optional[str] = None
+
+        if task.cancelled():
+            self._logger.warning('Deferred reply cancelled')
+        elif (e := task.exception()) is not None:
+            if isinstance(e, Exception):
+                message = render_exception(e)
+            if message is None:
+                self._logger.error('Failed to prepare deferred reply', exc_info=e)
+        else:
+            message = task.result()
+
+        if message is None:
+            self._done(task)
+        else:
+            self.queue.put_nowait((task, response_url, message))
+
+    def _done(self, task: asyncio.Task[str]) -> None:
+        self.pending.discard(task)
+        release = self.release_callbacks.pop(task, None)
+        if release is not None:
+            release()
+        if not self.pending:
+            self.idle.set()
+
+    async def send_task(self) -> None:
+        while True:
+            task, response_url, message = await self.queue.get()
+            try:
+                await self.nightbot.send_message(response_url, message)
+                self._logger.debug('Sent deferred reply')
+            except httpx.HTTPError as e:
+                self._logger.warning('Failed to send deferred reply: %r', e)
+            finally:
+                self._done(task)
+
+    async def drain(self) -> None:
+        """Waits for pending messages to be sent, up to the drain timeout"""
+        if self.idle.is_set():
+            return
+
+        self._logger.info('Waiting for %d deferred replies to be sent', len(self.pending))
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=self.settings.drain_timeout)
+        except TimeoutError:
+            self._logger.warning('Dropping %d deferred replies not sent in time', len(self.pending))
+
+    async def aclose(self) -> None:
+        """Drops pending messages, stops the background tasks and closes the client"""
+        tasks = [*self.pending, *self.send_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self.nightbot.aclose()
+
+
+def _create_deferred_replies() -> DeferredReplies:
+    return DeferredReplies(
+        nightbot=NightbotAPI(
+            client=httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    connect=settings.http.connect_timeout,
+                    read=settings.http.read_timeout,
+                    write=settings.http.write_timeout,
+                    pool=settings.http.pool_timeout,
+                ),
+            ),
+        ),
+        settings=settings.deferred_replies,
+    )
+
+
+deferred_replies = clients.register('nightbot.deferred_replies', _create_deferred_replies)
@@ -0,0 +1,377 @@
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+from random import uniform
+import select
+import signal
+import socket
+from time import monotonic, time
+from types import FrameType
+from typing import Any, Dict, List, NoReturn, Optional
+
+import uvicorn
+
+from .logging import configure_logging
+from .settings import settings
+
+
+# Signals handled by the supervisor, reset to their defaults in workers
+SUPERVISOR_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+
+# Consecutive workers failing before they ever become ready, after which the supervisor gives up
+MAX_STARTUP_FAILURES = 5
+
+
+class WorkerServer(uvicorn.Server):
+    """
+    uvicorn server which reports to the supervisor through a pipe from its event loop,
+    so that a worker with a blocked loop stops reporting just like a dead one
+    """
+
+    def __init__(self, config: uvicorn.Config, heartbeat_fd: int, heartbeat_interval: float) -> None:
+        super().__init__(config)
+        self.heartbeat_fd = heartbeat_fd
+        # `on_tick()` is called every 0.1 seconds
+        self.heartbeat_ticks = max(1, round(heartbeat_interval * 10))
+
+    async def on_tick(self, counter: int) -> bool:
+        if counter % self.heartbeat_ticks == 0:
+            self.send_heartbeat()
+        return await super().on_tick(counter)
+
+    def send_heartbeat(self) -> None:
+        heartbeat = f'{self.server_state.total_requests} {len(self.server_state.connections)}\n'
+        try:
+            os.write(self.heartbeat_fd, heartbeat.encode())
+        except BlockingIOError:
+            # The supervisor is behind on reading, it'll catch up with the next one
+            pass
+
+
+@dataclass
+class Worker:
+    pid: int
+    heartbeat_fd: int
+    started: float
+    # Recycled after this time, if the supervisor has a maximum worker age
+    recycle_at: Optional[float] = None
+
+    last_heartbeat: Optional[float] = None
+    requests: int = 0
+    connections: int = 0
+
+    # Worker being recycled, which is replaced by this one once it's ready
+    replaces: Optional[int] = None
+    recycle_requested: bool = False
+    stopping_since: Optional[float] = None
+    killed: bool = False
+
+    @property
+    def is_ready(self) -> bool:
+        return self.last_heartbeat is not None
+
+    def status(self, now: float) -> Dict[str, Any]:
+        return {
+            'pid': self.pid,
+            'age': round(now - self.started, 1),
+            'ready': self.is_ready,
+            'stopping': self.stopping_since is not None,
+            'last_heartbeat_ago': round(now - self.last_heartbeat, 1) if self.last_heartbeat is not None else None,
+            'requests': self.requests,
+            'connections': self.connections,
+        }
+
+
+class Supervisor:
+    """
+    Pre-forking supervisor: runs `workers` uvicorn workers, all accepting connections on the same listening socket
+
+    Workers are replaced when they exit, or stop sending heartbeats. They're recycled one at a time,
+    after `max_worker_age` seconds or on SIGHUP: a replacement is started first, and the old worker
+    is only stopped gracefully once the replacement is ready.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        config: Dict[str, Any],
+        workers: int,
+        max_worker_age: Optional[float] = None,
+        heartbeat_interval: float = 1.0,
+        heartbeat_timeout: float = 30.0,
+        startup_timeout: float = 60.0,
+        graceful_timeout: float = 30.0,
+        health_path: Optional[Path] = None,
+    ) -> None:
+        self._logger = logging.getLogger('nb4mna.runner')
+
+        self.sock = sock
+        self.config = config
+        self.workers_count = workers
+        self.max_worker_age = max_worker_age
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.graceful_timeout = graceful_timeout
+        self.health_path = health_path
+
+        self.workers: Dict[int, Worker] = {}
+        self.startup_failures = 0
+        self.should_exit = False
+        self.exit_code = 0
+        self.signals: List[int] = []
+
+    # region Worker process
+    def run_worker(self, heartbeat_fd: int) -> NoReturn:
+        code = 1
+
+        try:
+            for signum in SUPERVISOR_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+
+            # Background threads, like the one writing logs in queue mode, don't survive forking
+            configure_logging(settings.logging)
+
+            server = WorkerServer(uvicorn.Config(**self.config), heartbeat_fd, self.heartbeat_interval)
+            server.run(sockets=[self.sock])
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            self._logger.exception('Worker crashed')
+        finally:
+            logging.shutdown()
+            os._exit(code)
+    # endregion
+
+    # region Supervisor process
+    def spawn(self, replaces: Optional[int] = None) -> Worker:
+        read_fd, write_fd = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for worker in self.workers.values():
+                os.close(worker.heartbeat_fd)
+            os.set_blocking(write_fd, False)
+            self.run_worker(write_fd)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+
+        now = monotonic()
+        worker = Worker(pid=pid, heartbeat_fd=read_fd, started=now, replaces=replaces)
+        if self.max_worker_age is not None:
+            # Spread recycling out, so that workers started together aren't all recycled at once
+            worker.recycle_at = now + self.max_worker_age * uniform(0.9, 1.1)
+
+        self.workers[pid] = worker
+        self._logger.info('Started worker %d', pid)
+        return worker
+
+    def stop(self, worker: Worker) -> None:
+        if worker.stopping_since is not None:
+            return
+        worker.stopping_since = monotonic()
+        self._signal(worker, signal.SIGTERM)
+
+    def kill(self, worker: Worker) -> None:
+        if not worker.killed:
+            worker.killed = True
+            self._signal(worker, signal.SIGKILL)
+
+    def _signal(self, worker: Worker, signum: int) -> None:
+        try:
+            os.kill(worker.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def read_heartbeats(self, timeout: float) -> None:
+        fds = {worker.heartbeat_fd: worker for worker in self.workers.values()}
+        if not fds:
+            select.select([], [], [], timeout)
+            return
+
+        readable, _, _ = select.select(list(fds), [], [], timeout)
+        now = monotonic()
+
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                continue
+
+            # Only the latest complete heartbeat matters
+            lines = data.decode(errors='replace').strip().splitlines()
+            try:
+                requests, connections = (int(n) for n in lines[-1].split())
+            except (IndexError, ValueError):
+                continue
+
+            if not worker.is_ready:
+                self.worker_ready(worker)
+
+            worker.last_heartbeat = now
+            worker.requests = requests
+            worker.connections = connections
+
+    def worker_ready(self, worker: Worker) -> None:
+        self._logger.info('Worker %d is ready', worker.pid)
+        self.startup_failures = 0
+
+        replaced = self.workers.get(worker.replaces) if worker.replaces is not None else None
+        worker.replaces = None
+        if replaced is not None:
+            self._logger.info('Stopping worker %d, replaced by worker %d', replaced.pid, worker.pid)
+            self.stop(replaced)
+
+    def reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.heartbeat_fd)
+
+            if worker.stopping_since is not None:
+                self._logger.info('Worker %d stopped', pid)
+                continue
+
+            self._logger.warning('Worker %d exited unexpectedly (%s)', pid, self._describe_status(status))
+            if not worker.is_ready:
+                self.startup_failures += 1
+
+            # A replacement for this worker now simply takes its place
+            for other in self.workers.values():
+                if other.replaces == pid:
+                    other.replaces = None
+
+    @staticmethod
+    def _describe_status(status: int) -> str:
+        if os.WIFSIGNALED(status):
+            return f'killed by {signal.Signals(os.WTERMSIG(status)).name}'
+        return f'exit code {os.waitstatus_to_exitcode(status)}'
+
+    def check_health(self) -> None:
+        now = monotonic()
+
+        for worker in list(self.workers.values()):
+            if worker.stopping_since is not None:
+                if now - worker.stopping_since > self.graceful_timeout:
+                    self._logger.warning('Worker %d did not stop in time, killing', worker.pid)
+                    self.kill(worker)
+                continue
+
+            if worker.last_heartbeat is None:
+                if now - worker.started > self.startup_timeout:
+                    self._logger.warning('Worker %d did not become ready in time, killing', worker.pid)
+                    self.kill(worker)
+            elif now - worker.last_heartbeat > self.heartbeat_timeout:
+                self._logger.warning('Worker %d stopped sending heartbeats, killing', worker.pid)
+                self.kill(worker)
+
+    @staticmethod
+    def _is_due_for_recycling(worker: Worker, now: float) -> bool:
+        return worker.recycle_requested or (worker.recycle_at is not None and now >= worker.recycle_at)
+
+    def recycle(self) -> None:
+        """Starts a replacement for the oldest worker due for recycling, unless one is starting already"""
+        active = [worker for worker in self.workers.values() if worker.stopping_since is None]
+        if any(worker.replaces is not None and not worker.is_ready for worker in active):
+            return
+
+        now = monotonic()
+        due = [worker for worker in active if worker.is_ready and self._is_due_for_recycling(worker, now)]
+        if due:
+            worker = min(due, key=lambda w: w.started)
+            self._logger.info('Recycling worker %d', worker.pid)
+            self.spawn(replaces=worker.pid)
+
+    def maintain(self) -> None:
+        """Starts workers to make up for those that have exited"""
+        if self.startup_failures >= MAX_STARTUP_FAILURES:
+            self._logger.error('%d workers in a row failed to start, giving up', self.startup_failures)
+            self.should_exit = True
+            self.exit_code = 1
+            return
+
+        # Replacements of workers being recycled don't count, the workers they replace still do
+        active = [w for w in self.workers.values() if w.stopping_since is None and (w.replaces is None or w.is_ready)]
+        for _ in range(self.workers_count - len(active)):
+            self.spawn()
+
+    def write_health(self) -> None:
+        if self.health_path is None:
+            return
+
+        now = monotonic()
+        health = {
+            'pid': os.getpid(),
+            'time': time(),
+            'workers': [worker.status(now) for worker in self.workers.values()],
+        }
+
+        try:
+            temporary_path = self.health_path.with_name(f'.{self.health_path.name}.tmp')
+            temporary_path.write_text(json.dumps(health))
+            temporary_path.replace(self.health_path)
+        except OSError as e:
+            self._logger.warning('Failed to write health to %s: %r', self.health_path, e)
+
+    def handle_signal(self, signum: int, frame: Optional[FrameType]) -> None:
+        self.signals.append(signum)
+
+    def handle_signals(self) -> None:
+        while self.signals:
+            signum = self.signals.pop(0)
+
+            if signum == signal.SIGHUP:
+                self._logger.info('Received SIGHUP, recycling all workers')
+                for worker in self.workers.values():
+                    if worker.stopping_since is None and worker.is_ready:
+                        worker.recycle_requested = True
+            else:
+                self._logger.info('Received %s, stopping', signal.Signals(signum).name)
+                self.should_exit = True
+
+    def shutdown(self) -> None:
+        for worker in self.workers.values():
+            self.stop(worker)
+
+        while self.workers:
+            self.read_heartbeats(timeout=0.1)
+            self.reap()
+            self.check_health()
+
+    def run(self) -> int:
+        for signum in SUPERVISOR_SIGNALS:
+            signal.signal(signum, self.handle_signal)
+
+        self._logger.info('Starting %d workers on %r', self.workers_count, self.sock.getsockname())
+
+        while not self.should_exit:
+            self.maintain()
+            self.read_heartbeats(timeout=0.5)
+            self.reap()
+            self.handle_signals()
+            self.check_health()
+            self.recycle()
+            self.write_health()
+
+        self.shutdown()
+        self.write_health()
+        self.sock.close()
+
+        return self.exit_code
+    # endregion
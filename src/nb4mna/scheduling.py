@@ -0,0 +1,306 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+import logging
+from math import ceil
+from time import monotonic, time
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+from httpx import codes, Request, Response, TransportError
+from pydantic import BaseModel
+
+from .deadlines import get_deadline
+
+
+class UpstreamSettings(BaseModel):
+    # Sustained requests per second and burst size, unlimited if rate isn't set
+    rate_limit: Optional[float] = None
+    rate_limit_burst: int = 10
+    # Longest a request may wait for its turn before failing instead
+    max_wait: float = 5.0
+    max_concurrency: int = 10
+    # Consecutive failures that open the circuit, and how long it stays open
+    circuit_breaker_threshold: int = 5
+    circuit_breaker_reset_timeout: float = 30.0
+    # Send a GET request once more when it takes longer than this percentile of recent response times
+    # of its endpoint, using whichever response comes first; disabled if not set
+    hedge_percentile: Optional[float] = None
+    hedge_window: int = 100
+    hedge_min_samples: int = 20
+
+
+# region Exceptions
+@dataclass
+class UpstreamUnavailableException(Exception):
+    name: str
+    reason: str
+    retry_in: float
+
+    def __str__(self) -> str:
+        return f'{self.name} is {self.reason}, try again in {ceil(self.retry_in)} seconds'
+# endregion
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        # Tokens may be negative after `pause()`, in which case they refill back to zero first
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` are available"""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def reserve(self, max_wait: float, tokens: float = 1.0) -> Optional[float]:
+        """
+        Takes `tokens` now, possibly going into debt, if they'd be available within `max_wait` seconds
+
+        Returns the seconds to wait before using them, or None, taking nothing, if that's longer than `max_wait`.
+        Later callers queue up behind the debt, so waits are bounded no matter how many callers there are.
+        """
+        wait = self.delay(tokens)
+        if wait > max_wait:
+            return None
+        self.tokens -= tokens
+        return wait
+
+    def refund(self, tokens: float = 1.0) -> None:
+        """Gives back reserved tokens that weren't used after all"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, duration: float) -> None:
+        """Drains the bucket, so that no tokens are available for `duration` seconds"""
+        self._refill()
+        self.tokens = min(self.tokens, -duration * self.rate)
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `threshold` consecutive failures, for `reset_timeout` seconds,
+    then lets a single trial request through to decide whether to close again
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened: Optional[float] = None
+        self.trial_in_progress = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened is not None
+
+    def retry_in(self) -> Optional[float]:
+        """Seconds until requests are let through again, or None if a request may go ahead now"""
+        if self.opened is None:
+            return None
+
+        remaining = self.opened + self.reset_timeout - monotonic()
+        if remaining > 0:
+            return remaining
+
+        if self.trial_in_progress:
+            return self.reset_timeout
+
+        self.trial_in_progress = True
+        return None
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened = None
+        self.trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_progress = False
+
+        if self.opened is not None or self.failures >= self.threshold:
+            self.opened = monotonic()
+
+
+class UpstreamScheduler:
+    """
+    Paces requests to one upstream API: token bucket rate limiting, honouring `Retry-After`,
+    bounded concurrency and a circuit breaker
+
+    Also keeps track of response times per endpoint, to decide when requests are worth hedging.
+    """
+
+    def __init__(self, name: str, settings: UpstreamSettings) -> None:
+        self._logger = logging.getLogger(f'nb4mna.scheduling.{name}')
+
+        self.name = name
+        self.max_wait = settings.max_wait
+
+        self.bucket = (
+            TokenBucket(rate=settings.rate_limit, capacity=settings.rate_limit_burst) if settings.rate_limit else None
+        )
+        self.retry_after = 0.0
+        self.concurrency = asyncio.Semaphore(settings.max_concurrency)
+        self.circuit_breaker = CircuitBreaker(
+            threshold=settings.circuit_breaker_threshold,
+            reset_timeout=settings.circuit_breaker_reset_timeout,
+        )
+
+        self.hedge_percentile = settings.hedge_percentile
+        self.hedge_window = settings.hedge_window
+        self.hedge_min_samples = settings.hedge_min_samples
+        self.response_times: Dict[str, Deque[float]] = {}
+
+    @staticmethod
+    def parse_retry_after(response: Response) -> Optional[float]:
+        value = response.headers.get('Retry-After', None)
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+    def record_response_time(self, endpoint: str, duration: float) -> None:
+        if self.hedge_percentile is None:
+            return
+
+        response_times = self.response_times.get(endpoint, None)
+        if response_times is None:
+            response_times = self.response_times[endpoint] = deque(maxlen=self.hedge_window)
+        response_times.append(duration)
+
+    def hedge_delay(self, endpoint: str) -> Optional[float]:
+        """Time after which a request to `endpoint` still waiting for a response is hedged, None if it isn't"""
+        if self.hedge_percentile is None:
+            return None
+
+        response_times = self.response_times.get(endpoint, None)
+        if response_times is None or len(response_times) < self.hedge_min_samples:
+            return None
+
+        ordered = sorted(response_times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    @asynccontextmanager
+    async def turn(self) -> AsyncIterator[None]:
+        """
+        Waits for this request's turn, failing fast if that would take longer than `max_wait`,
+        or past the deadline of the request
+
+        A rate limit token is reserved up front, so that concurrent requests queue up behind each other's reservations
+        instead of all seeing the same short wait. Waiting for a free concurrency slot counts against the same budget.
+        """
+        start = monotonic()
+        # No point in waiting past the deadline of the request
+        deadline = get_deadline()
+        max_wait = self.max_wait if deadline is None else min(self.max_wait, max(deadline.remaining(), 0.0))
+
+        delay = max(self.retry_after - start, 0.0)
+        if delay > max_wait:
+            raise UpstreamUnavailableException(name=self.name, reason='rate limited', retry_in=delay)
+
+        if self.bucket:
+            bucket_delay = self.bucket.reserve(max_wait)
+            if bucket_delay is None:
+                raise UpstreamUnavailableException(name=self.name, reason='rate limited', retry_in=self.bucket.delay())
+            delay = max(delay, bucket_delay)
+
+        try:
+            if delay > 0:
+                self._logger.debug('Throttling request for %.2f seconds', delay)
+                await asyncio.sleep(delay)
+
+            if self.concurrency.locked():
+                try:
+                    await asyncio.wait_for(self.concurrency.acquire(), max(max_wait - (monotonic() - start), 0.0))
+                except TimeoutError:
+                    raise UpstreamUnavailableException(name=self.name, reason='busy', retry_in=self.max_wait) from None
+            else:
+                await self.concurrency.acquire()
+        except BaseException:
+            # The token wasn't used, let another request have it
+            if self.bucket:
+                self.bucket.refund()
+            raise
+
+        try:
+            yield
+        finally:
+            self.concurrency.release()
+
+    def record_failure(self) -> None:
+        self.circuit_breaker.record_failure()
+        if self.circuit_breaker.is_open:
+            self._logger.warning(f'Circuit open after {self.circuit_breaker.failures} consecutive failures')
+
+    def record_response(self, response: Response) -> None:
+        if response.status_code == codes.TOO_MANY_REQUESTS:
+            retry_after = self.parse_retry_after(response)
+            if retry_after is None:
+                retry_after = 1.0 / self.bucket.rate if self.bucket else 1.0
+
+            self._logger.warning(f'Rate limited by upstream, pausing for {retry_after:.1f} seconds')
+            self.retry_after = max(self.retry_after, monotonic() + retry_after)
+            if self.bucket:
+                self.bucket.pause(retry_after)
+        elif response.status_code >= 500:
+            self.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    async def send(self, send: Callable[[Request], Awaitable[Response]], request: Request) -> Response:
+        """Makes an upstream request with `send` once it's this request's turn"""
+        # A single retry is made when rate limited, if the upstream asks to wait no longer than we're willing to
+        for attempt in range(2):
+            retry_in = self.circuit_breaker.retry_in()
+            if retry_in is not None:
+                raise UpstreamUnavailableException(name=self.name, reason='unavailable', retry_in=retry_in)
+            is_trial = self.circuit_breaker.is_open
+
+            try:
+                async with self.turn():
+                    response = await send(request)
+            except TransportError:
+                self.record_failure()
+                raise
+            finally:
+                # Let another request try, should this trial have been cut short
+                if is_trial:
+                    self.circuit_breaker.trial_in_progress = False
+
+            self.record_response(response)
+
+            if response.status_code != codes.TOO_MANY_REQUESTS or attempt > 0:
+                break
+            if self.retry_after - monotonic() > self.max_wait:
+                break
+
+        return response
@@ -1,10 +1,89 @@
+from pathlib import Path
+from typing import List, Optional
+
+from pydantic import BaseModel, HttpUrl
 from pydantic_settings import BaseSettings
 
+from .capture import CaptureSettings
+from .clients import CacheSettings, HTTPCacheSettings, HTTPClientSettings
+from .diagnostics import DiagnosticsSettings
+from .logging import LoggingSettings
 from .modules.fight.settings import TatsumakiSettings
+from .scheduling import UpstreamSettings
+from .throttling import ThrottlingSettings
+
+
+class DeadlineSettings(BaseModel):
+    # Time budget per command for all of its upstream calls, past which they're cancelled; unlimited if not set
+    fight: Optional[float] = None
+    urban: Optional[float] = None
+
+
+class DeferredReplySettings(BaseModel):
+    # Reply through Nightbot's response URL when a message isn't ready in `budget` seconds,
+    # rather than leaving Nightbot to time out waiting for it
+    enabled: bool = False
+    budget: float = 2.0
+    # Replied at once when deferring, nothing is said in chat if empty
+    placeholder: str = ''
+    # Messages being prepared or sent in the background at most, beyond which requests wait for theirs as usual
+    max_pending: int = 100
+    max_concurrent_sends: int = 4
+    # Longest shutdown waits for pending messages to be sent
+    drain_timeout: float = 10.0
+    # Response URLs only ever point at Nightbot, but come from a header anyone can set,
+    # so replies are only deferred to URLs with one of these schemes, hosts and ports
+    response_url_origins: List[HttpUrl] = [HttpUrl('https://api.nightbot.tv')]
+
+
+class WarmupSettings(BaseModel):
+    # Open connections to the upstream APIs at startup, rather than on the first request
+    prewarm_connections: bool = False
+    # Keep those connections from going idle by pinging the APIs this often
+    keepalive_interval: Optional[float] = None
+    # Longest startup waits for connections and preloading before serving requests anyway
+    timeout: float = 10.0
+
+
+# Defined here rather than in `modules/urban/settings.py`,
+# because importing that would initialise the urban module before these settings are loaded
+class UrbanCacheSettings(HTTPCacheSettings):
+    # A default of its own, that's kept when other cache settings are overridden
+    duration: float = 600.0
+
+
+class UrbanSettings(BaseModel):
+    cache: UrbanCacheSettings = UrbanCacheSettings()
+    # Parsed autocompletions and definitions cached at most, each
+    result_cache_max_entries: int = 1024
+    result_cache_max_size: Optional[int] = None
+    # Request the definition of a term along with its autocompletion, instead of waiting for the latter
+    speculative_define: bool = False
+    # Finished replies, negative ones included, per case-folded term
+    response_cache_duration: float = 300.0
+    response_cache_max_entries: int = 4096
+    response_cache_max_size: Optional[int] = 4 * 1024 * 1024
+    # File keeping every term seen, so that known terms are looked up without autocompletion, disabled if not set
+    term_index_path: Optional[Path] = None
+    term_index_max_terms: int = 100_000
+    # Terms to look up at startup
+    preload_terms: List[str] = []
+
+    upstream: UpstreamSettings = UpstreamSettings()
 
 
 class Settings(BaseSettings):
+    cache: CacheSettings = CacheSettings()
+    capture: CaptureSettings = CaptureSettings()
+    deadlines: DeadlineSettings = DeadlineSettings()
+    deferred_replies: DeferredReplySettings = DeferredReplySettings()
+    diagnostics: DiagnosticsSettings = DiagnosticsSettings()
+    http: HTTPClientSettings = HTTPClientSettings()
+    logging: LoggingSettings = LoggingSettings()
     tatsumaki: TatsumakiSettings
+    throttling: ThrottlingSettings = ThrottlingSettings()
+    urban: UrbanSettings = UrbanSettings()
+    warmup: WarmupSettings = WarmupSettings()
 
     class Config:
         env_file = '.env'
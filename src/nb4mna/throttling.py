@@ -0,0 +1,208 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import logging
+from math import ceil
+from time import monotonic
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel
+
+from .api.nightbot import NightbotData, NightbotOptionalDepends
+from .metrics import registry
+from .scheduling import TokenBucket
+
+
+throttled_commands = registry.counter(
+    'nb4mna_throttled_commands_total',
+    'Commands turned away before being handled, per reason',
+)
+
+
+class ThrottlingSettings(BaseModel):
+    # Turn commands away with a short reply, rather than let a flood of them slow everyone down
+    enabled: bool = False
+    # Sustained commands per second and burst size, per user and per channel; unlimited if rate isn't set
+    user_rate_limit: Optional[float] = None
+    user_rate_limit_burst: int = 3
+    channel_rate_limit: Optional[float] = None
+    channel_rate_limit_burst: int = 20
+    # Commands handled at once at most, unlimited if not set, and how many more may wait for how long
+    max_concurrency: Optional[int] = None
+    max_waiting: int = 50
+    max_wait: float = 2.0
+    # Replies to commands turned away, `{retry_in}` being seconds until they'd be let through; may be empty
+    user_message: str = "You're doing that too often, try again in {retry_in} seconds"
+    channel_message: str = 'Too many commands in this channel, try again in {retry_in} seconds'
+    overloaded_message: str = 'Too busy right now, try again in a bit'
+
+
+# region Exceptions
+@dataclass
+class CommandThrottledException(Exception):
+    reason: str
+    message: str
+
+    def __str__(self) -> str:
+        return self.message
+# endregion
+
+
+class CommandSlot:
+    """
+    Concurrency slot a command is handled in, released once its request has been handled,
+    unless it's handed over to be released later, such as once a deferred reply has been sent
+    """
+
+    def __init__(self, slots: Optional[asyncio.Semaphore] = None) -> None:
+        self.slots = slots
+        self.handed_over = False
+
+    def hand_over(self) -> Callable[[], None]:
+        """Keeps the slot past the request, returns the function releasing it"""
+        self.handed_over = True
+        return self.release
+
+    def release(self) -> None:
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+
+
+class Throttler:
+    """
+    Turns commands away before they're handled, with a short reply instead:
+    when their user or channel sends too many of them, or when too many are being handled already
+
+    Rate limits are token buckets per user and per channel. Buckets that have refilled completely
+    are no different from new ones, so they're dropped every now and then, keeping as many as there are active users.
+    """
+
+    # Seconds between sweeps of refilled buckets
+    SWEEP_INTERVAL = 60.0
+
+    def __init__(self, settings: ThrottlingSettings) -> None:
+        self._logger = logging.getLogger('nb4mna.throttling')
+
+        self.settings = settings
+
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        self.channel_buckets: Dict[str, TokenBucket] = {}
+        self.swept = monotonic()
+
+        self.slots = asyncio.Semaphore(settings.max_concurrency) if settings.max_concurrency else None
+        self.waiting = 0
+
+    @staticmethod
+    def _get_bucket(buckets: Dict[str, TokenBucket], key: str, rate: float, capacity: int) -> TokenBucket:
+        bucket = buckets.get(key, None)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate=rate, capacity=capacity)
+        return bucket
+
+    def _sweep(self) -> None:
+        now = monotonic()
+        if now - self.swept < self.SWEEP_INTERVAL:
+            return
+        self.swept = now
+
+        for buckets in (self.user_buckets, self.channel_buckets):
+            for key in [key for key, bucket in buckets.items() if bucket.delay(bucket.capacity) == 0]:
+                del buckets[key]
+
+    def _reject(self, reason: str, message: str, retry_in: float = 0.0) -> None:
+        self._logger.info('Rejected command: %s', reason)
+        throttled_commands.inc(reason=reason)
+        raise CommandThrottledException(reason=reason, message=message.format(retry_in=max(1, ceil(retry_in))))
+
+    def check_rate_limits(self, nightbot: NightbotData) -> None:
+        self._sweep()
+
+        limits: List[Tuple[str, TokenBucket, str]] = []
+        if self.settings.channel_rate_limit:
+            bucket = self._get_bucket(
+                self.channel_buckets,
+                f'{nightbot.channel.provider}:{nightbot.channel.providerId}',
+                rate=self.settings.channel_rate_limit,
+                capacity=self.settings.channel_rate_limit_burst,
+            )
+            limits.append(('channel', bucket, self.settings.channel_message))
+        if self.settings.user_rate_limit:
+            bucket = self._get_bucket(
+                self.user_buckets,
+                f'{nightbot.user.provider}:{nightbot.user.providerId or nightbot.user.name}',
+                rate=self.settings.user_rate_limit,
+                capacity=self.settings.user_rate_limit_burst,
+            )
+            limits.append(('user', bucket, self.settings.user_message))
+
+        # Tokens are only taken once every limit lets the command through
+        for reason, bucket, message in limits:
+            retry_in = bucket.delay()
+            if retry_in > 0:
+                self._reject(reason, message, retry_in)
+        for _, bucket, _ in limits:
+            bucket.try_acquire()
+
+    async def acquire_slot(self) -> None:
+        assert self.slots is not None  # noqa: S101
+
+        # Shed load rather than have commands queue up for longer than Nightbot waits for a reply
+        if self.slots.locked() and self.waiting >= self.settings.max_waiting:
+            self._reject('overloaded', self.settings.overloaded_message)
+
+        self.waiting += 1
+        try:
+            async with asyncio.timeout(self.settings.max_wait):
+                await self.slots.acquire()
+        except TimeoutError:
+            self._reject('overloaded', self.settings.overloaded_message)
+        finally:
+            self.waiting -= 1
+
+    @asynccontextmanager
+    async def admit(self, nightbot: Optional[NightbotData]) -> AsyncIterator[CommandSlot]:
+        """Handles a command within, or raises `CommandThrottledException` if it's turned away"""
+        if not self.settings.enabled:
+            yield CommandSlot()
+            return
+
+        if nightbot is not None:
+            self.check_rate_limits(nightbot)
+
+        if self.slots is None:
+            yield CommandSlot()
+            return
+
+        await self.acquire_slot()
+        slot = CommandSlot(self.slots)
+        try:
+            yield slot
+        finally:
+            if not slot.handed_over:
+                slot.release()
+
+
+# Lets every command through until installed
+throttler = Throttler(ThrottlingSettings())
+
+
+async def _dependency(nightbot: Optional[NightbotData] = NightbotOptionalDepends) -> AsyncIterator[CommandSlot]:
+    async with throttler.admit(nightbot) as slot:
+        yield slot
+
+
+ThrottlingDepends = Depends(_dependency)
+
+
+def _exception_handler(request: Request, exc: Exception) -> Response:
+    return PlainTextResponse(str(exc))
+
+
+def install(app: FastAPI, settings: ThrottlingSettings) -> None:
+    global throttler
+    throttler = Throttler(settings)
+
+    app.add_exception_handler(CommandThrottledException, _exception_handler)
@@ -0,0 +1,6 @@
+import os
+
+
+# Importing the app loads its settings, which need these
+os.environ.setdefault('TATSUMAKI__API_KEY', 'test')
+os.environ.setdefault('TATSUMAKI__GUILD_ID', '1')
@@ -0,0 +1,256 @@
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time
+from typing import Any, Callable, List, Optional, Tuple
+import unittest
+from unittest import mock
+
+import httpx
+from nb4mna.caching import AsyncCachedHTTPTransport, CacheStore
+from nb4mna.deadlines import Deadline, deadline, get_deadline
+from nb4mna.diskcache import SharedSQLiteCacheBackend
+
+
+URL = 'https://example.com/resource'
+
+
+class FakeUpstream:
+    """Stands in for the network below `AsyncCachedHTTPTransport`, answering each request after `delay` seconds"""
+
+    def __init__(self, respond: Callable[[httpx.Request], httpx.Response], delay: float = 0.0) -> None:
+        self.respond = respond
+        self.delay = delay
+        self.requests: List[httpx.Request] = []
+        # Deadline each request was made within
+        self.deadlines: List[Optional[Deadline]] = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        self.deadlines.append(get_deadline())
+        await asyncio.sleep(self.delay)
+        return self.respond(request)
+
+
+def ok(
+    content: bytes = b'content', headers: Optional[List[Tuple[str, str]]] = None
+) -> Callable[[httpx.Request], httpx.Response]:
+    return lambda request: httpx.Response(httpx.codes.OK, headers=headers, stream=httpx.ByteStream(content))
+
+
+class CacheStoreTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self) -> None:
+        store: CacheStore[str, int] = CacheStore(max_entries=2)
+        store.set('a', 1, expires=time() + 60)
+        store.set('b', 2, expires=time() + 60)
+        store.get('a')
+        store.set('c', 3, expires=time() + 60)
+
+        self.assertTrue('a' in store)
+        self.assertFalse('b' in store)
+        self.assertTrue('c' in store)
+        self.assertEqual(store.evictions, 1)
+
+    def test_evicts_for_size(self) -> None:
+        store: CacheStore[str, int] = CacheStore(max_size=10)
+        store.set('a', 1, expires=time() + 60, size=6)
+        store.set('b', 2, expires=time() + 60, size=6)
+
+        self.assertFalse('a' in store)
+        self.assertEqual(store.size, 6)
+
+        # Overwriting an entry replaces its size rather than adding to it
+        store.set('b', 2, expires=time() + 60, size=4)
+        self.assertEqual(store.size, 4)
+
+    def test_stats(self) -> None:
+        store: CacheStore[str, int] = CacheStore()
+        store.set('a', 1, expires=time() + 60, size=1)
+        store.set('b', 2, expires=time() - 1, size=1)
+
+        self.assertEqual(store.get('a'), 1)
+        self.assertIsNone(store.get('b'))
+        self.assertIsNone(store.get('c'))
+        self.assertIsNone(store.get('c', record_stats=False))
+
+        stats = store.stats
+        self.assertEqual((stats.entries, stats.size), (1, 1))
+        self.assertEqual((stats.hits, stats.misses, stats.expirations), (1, 2, 1))
+
+    def test_expire(self) -> None:
+        store: CacheStore[str, int] = CacheStore()
+        now = time()
+        store.set('a', 1, expires=now + 1)
+        store.set('b', 2, expires=now + 2)
+        # Overwritten with a later expiry, its earlier one is ignored
+        store.set('a', 1, expires=now + 3)
+
+        self.assertEqual(store.next_expiry(), now + 1)
+        self.assertEqual(store.expire(now + 2), ['b'])
+        self.assertEqual(store.expire(now + 3), ['a'])
+        self.assertEqual(len(store), 0)
+
+
+class AsyncCachedHTTPTransportTest(unittest.IsolatedAsyncioTestCase):
+    def use_upstream(self, upstream: FakeUpstream) -> None:
+        patcher = mock.patch.object(httpx.AsyncHTTPTransport, 'handle_async_request', upstream)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def create_transport(self, **kwargs: Any) -> AsyncCachedHTTPTransport:
+        transport = AsyncCachedHTTPTransport(name='test', **kwargs)
+        self.addAsyncCleanup(transport.aclose)
+        return transport
+
+    @staticmethod
+    async def get(transport: AsyncCachedHTTPTransport) -> httpx.Response:
+        response = await transport.handle_async_request(httpx.Request('GET', URL))
+        await response.aread()
+        return response
+
+    async def test_caches_responses(self) -> None:
+        upstream = FakeUpstream(ok())
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=60)
+
+        await self.get(transport)
+        response = await self.get(transport)
+
+        self.assertEqual(response.content, b'content')
+        self.assertIn('Age', response.headers)
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual((transport.cache.hits, transport.cache.misses), (1, 1))
+
+    async def test_coalesces_concurrent_misses(self) -> None:
+        upstream = FakeUpstream(ok(), delay=0.05)
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=60)
+
+        responses = await asyncio.gather(*(self.get(transport) for _ in range(10)))
+
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertTrue(all(response.content == b'content' for response in responses))
+
+    async def test_coalesced_request_survives_cancelled_caller(self) -> None:
+        upstream = FakeUpstream(ok(), delay=0.05)
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=60)
+
+        first = asyncio.create_task(self.get(transport))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(self.get(transport))
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        response = await second
+        self.assertEqual(response.content, b'content')
+        self.assertEqual(len(upstream.requests), 2)
+
+    async def test_stale_while_revalidate(self) -> None:
+        upstream = FakeUpstream(ok(b'old'))
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=0.05, stale_while_revalidate=True, max_stale=60)
+
+        await self.get(transport)
+        await asyncio.sleep(0.1)
+
+        upstream.respond = ok(b'new')
+        upstream.delay = 0.05
+        # Served stale right away, from a request whose deadline passes before the refresh is done
+        with deadline(0.01):
+            response = await self.get(transport)
+        self.assertEqual(response.content, b'old')
+
+        await asyncio.gather(*transport.revalidation_tasks)
+        self.assertIsNone(upstream.deadlines[1])
+        upstream.delay = 0.0
+        response = await self.get(transport)
+        self.assertEqual(response.content, b'new')
+        self.assertEqual(len(upstream.requests), 2)
+
+    async def test_stale_if_error(self) -> None:
+        upstream = FakeUpstream(ok(b'old'))
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=0.05, max_stale=60)
+
+        await self.get(transport)
+        await asyncio.sleep(0.1)
+
+        upstream.respond = lambda request: httpx.Response(httpx.codes.BAD_GATEWAY, stream=httpx.ByteStream(b''))
+        response = await self.get(transport)
+        self.assertEqual(response.status_code, httpx.codes.OK)
+        self.assertEqual(response.content, b'old')
+
+        def fail(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectError('unreachable', request=request)
+
+        upstream.respond = fail
+        response = await self.get(transport)
+        self.assertEqual(response.content, b'old')
+
+    async def test_stale_past_max_stale_is_not_served(self) -> None:
+        upstream = FakeUpstream(ok(b'old'))
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=0.05, max_stale=0.05)
+
+        await self.get(transport)
+        await asyncio.sleep(0.15)
+
+        upstream.respond = lambda request: httpx.Response(httpx.codes.BAD_GATEWAY, stream=httpx.ByteStream(b''))
+        response = await self.get(transport)
+        self.assertEqual(response.status_code, httpx.codes.BAD_GATEWAY)
+
+    async def test_revalidates_with_etag(self) -> None:
+        upstream = FakeUpstream(ok(b'content', headers=[('ETag', '"v1"')]))
+        self.use_upstream(upstream)
+        transport = await self.create_transport(cache_duration=0.05, conditional_requests=True)
+
+        await self.get(transport)
+        await asyncio.sleep(0.1)
+
+        upstream.respond = lambda request: httpx.Response(
+            httpx.codes.NOT_MODIFIED, headers=[('ETag', '"v1"')], stream=httpx.ByteStream(b'')
+        )
+        response = await self.get(transport)
+
+        self.assertEqual(upstream.requests[1].headers['If-None-Match'], '"v1"')
+        self.assertEqual(response.status_code, httpx.codes.OK)
+        self.assertEqual(response.content, b'content')
+
+        # Renewed, so fresh again
+        response = await self.get(transport)
+        self.assertEqual(len(upstream.requests), 2)
+
+    async def test_shared_backend_fetches_once_across_transports(self) -> None:
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'cache.db'
+
+        upstream = FakeUpstream(ok(b'old'))
+        self.use_upstream(upstream)
+        fetching, waiting = [
+            await self.create_transport(
+                cache_duration=0.1, max_stale=60, backend=SharedSQLiteCacheBackend(path, namespace='test')
+            )
+            for _ in range(2)
+        ]
+
+        await self.get(fetching)
+        await asyncio.sleep(0.15)
+
+        upstream.respond = ok(b'new')
+        upstream.delay = 0.3
+        with mock.patch.object(waiting.cache, 'set', wraps=waiting.cache.set) as cache_set:
+            fetched = asyncio.create_task(self.get(fetching))
+            await asyncio.sleep(0.05)
+            response = await self.get(waiting)
+            await fetched
+
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(response.content, b'new')
+        # The stale response found at first, then the fresh one once stored, rather than on every poll
+        self.assertEqual(cache_set.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
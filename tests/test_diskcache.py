@@ -0,0 +1,65 @@
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep, time
+import unittest
+
+from nb4mna.diskcache import DiskCacheEntry, SQLiteCacheTier
+
+
+class SQLiteCacheTierTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'cache.db'
+
+    async def test_round_trip_across_instances(self) -> None:
+        entry = DiskCacheEntry(value=b'value', time=time(), expires=time() + 60)
+
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        tier.put('key', entry)
+        await tier.aclose()
+
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        try:
+            self.assertEqual(await tier.get('key'), entry)
+            self.assertIsNone(await tier.get('missing'))
+        finally:
+            await tier.aclose()
+
+    async def test_other_namespaces_and_expired_entries_are_not_found(self) -> None:
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        tier.put('expired', DiskCacheEntry(value=b'value', time=time() - 60, expires=time() - 1))
+        await tier.aclose()
+
+        tier = SQLiteCacheTier(self.path, namespace='other')
+        tier.put('key', DiskCacheEntry(value=b'value', time=time(), expires=time() + 60))
+        await tier.aclose()
+
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        try:
+            self.assertIsNone(await tier.get('expired'))
+            self.assertIsNone(await tier.get('key'))
+        finally:
+            await tier.aclose()
+
+    async def test_close_writes_batch_in_hand(self) -> None:
+        entry = DiskCacheEntry(value=b'value', time=time(), expires=time() + 60)
+
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        # Keep the database thread busy, so that the writer's batch is still waiting for it when closing
+        tier._executor.submit(sleep, 0.2)
+        tier.put('key', entry)
+        await asyncio.sleep(0.05)
+        self.assertTrue(tier.write_queue.empty())
+        await tier.aclose()
+
+        tier = SQLiteCacheTier(self.path, namespace='test')
+        try:
+            self.assertEqual(await tier.get('key'), entry)
+        finally:
+            await tier.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from nb4mna.api.nightbot import _optional_dependency
+
+
+USER = 'name=user&displayName=User&provider=discord&providerId=1&userLevel=everyone'
+CHANNEL = 'name=channel&displayName=Channel&provider=discord&providerId=2'
+RESPONSE_URL = 'https://api.nightbot.tv/1/channel/send/abc'
+
+
+class OptionalNightbotDependencyTest(unittest.TestCase):
+    def test_valid_headers(self) -> None:
+        nightbot = _optional_dependency(RESPONSE_URL, USER, CHANNEL)
+        self.assertIsNotNone(nightbot)
+        if nightbot is not None:
+            self.assertEqual(nightbot.user.providerId, '1')
+            self.assertEqual(nightbot.channel.providerId, '2')
+
+    def test_missing_headers(self) -> None:
+        self.assertIsNone(_optional_dependency(None, USER, CHANNEL))
+        self.assertIsNone(_optional_dependency(RESPONSE_URL, None, CHANNEL))
+
+    def test_invalid_headers_are_ignored(self) -> None:
+        self.assertIsNone(_optional_dependency('not a url', USER, CHANNEL))
+        self.assertIsNone(_optional_dependency(RESPONSE_URL, 'garbage', CHANNEL))
+        self.assertIsNone(_optional_dependency(RESPONSE_URL, 'name=user', CHANNEL))
+        self.assertIsNone(_optional_dependency(RESPONSE_URL, USER, '%%%&&&'))
+
+
+if __name__ == '__main__':
+    unittest.main()
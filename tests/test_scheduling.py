@@ -0,0 +1,58 @@
+import asyncio
+from time import monotonic
+from typing import List
+import unittest
+
+import httpx
+from nb4mna.scheduling import UpstreamScheduler, UpstreamSettings, UpstreamUnavailableException
+
+
+async def respond(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(httpx.codes.OK, request=request)
+
+
+class UpstreamSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_fails_fast_past_max_wait(self) -> None:
+        scheduler = UpstreamScheduler(
+            'test', UpstreamSettings(rate_limit=1.0, rate_limit_burst=2, max_wait=1.0, max_concurrency=10)
+        )
+        request = httpx.Request('GET', 'https://example.com/')
+        start = monotonic()
+
+        async def send() -> float:
+            await scheduler.send(respond, request)
+            return monotonic() - start
+
+        results = await asyncio.gather(*(send() for _ in range(8)), return_exceptions=True)
+
+        sent: List[float] = sorted(result for result in results if isinstance(result, float))
+        failed = [result for result in results if isinstance(result, UpstreamUnavailableException)]
+
+        # Two from the burst right away, one after waiting a second for a token, and the rest not at all
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(len(failed), 5)
+        self.assertLess(sent[1], 0.1)
+        self.assertAlmostEqual(sent[2], 1.0, delta=0.1)
+        self.assertLess(monotonic() - start, 1.5)
+
+    async def test_concurrency_wait_counts_against_max_wait(self) -> None:
+        scheduler = UpstreamScheduler('test', UpstreamSettings(max_wait=0.2, max_concurrency=1))
+        request = httpx.Request('GET', 'https://example.com/')
+
+        async def respond_slowly(request: httpx.Request) -> httpx.Response:
+            await asyncio.sleep(1.0)
+            return await respond(request)
+
+        slow = asyncio.create_task(scheduler.send(respond_slowly, request))
+        await asyncio.sleep(0)
+
+        start = monotonic()
+        with self.assertRaises(UpstreamUnavailableException):
+            await scheduler.send(respond, request)
+        self.assertLess(monotonic() - start, 0.5)
+
+        await slow
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import asyncio
+from time import time
+from typing import List
+import unittest
+
+import httpx
+from nb4mna.api.nightbot import NightbotChannel
+from nb4mna.deadlines import deadline
+from nb4mna.modules.fight.settings import TatsumakiGuildSettings, TatsumakiSettings
+from nb4mna.modules.fight.tenants import TatsumakiTenants
+
+
+class TatsumakiTenantsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_refresh_outlives_deadline_of_request_creating_client(self) -> None:
+        requests: List[httpx.Request] = []
+
+        async def respond(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            await asyncio.sleep(0.01)
+            return httpx.Response(httpx.codes.OK, json={'guild_id': 2, 'rankings': []})
+
+        tenants = TatsumakiTenants(
+            httpx.AsyncClient(transport=httpx.MockTransport(respond)),
+            TatsumakiSettings(
+                api_key='test',
+                guild_id=1,
+                guilds={'500': TatsumakiGuildSettings(guild_id=2, leaderboard_refresh_interval=0.1)},
+            ),
+        )
+        channel = NightbotChannel(name='c', displayName='C', provider='discord', providerId='500')
+
+        try:
+            # Created by a request, whose deadline passes long before the refreshes below
+            with deadline(0.05):
+                tatsumaki = tenants.get(channel)
+
+            await asyncio.sleep(0.45)
+
+            # Refreshed every 0.1 seconds all along, not only before the deadline
+            self.assertGreaterEqual(len(requests), 4)
+            leaderboard = tatsumaki.leaderboard
+            self.assertIsNotNone(leaderboard)
+            if leaderboard is not None:
+                self.assertLess(time() - leaderboard.time, 0.2)
+        finally:
+            await tenants.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+from typing import List
+import unittest
+from unittest import mock
+
+from nb4mna.api.nightbot import NightbotAPI, NightbotChannel, NightbotData, NightbotUser
+from nb4mna.replies import DeferredReplies
+from nb4mna.settings import DeferredReplySettings
+from nb4mna.throttling import CommandThrottledException, Throttler, ThrottlingSettings
+from pydantic import HttpUrl
+
+
+def make_nightbot(user_id: str = '1', channel_id: str = '2') -> NightbotData:
+    return NightbotData(
+        response_url=HttpUrl('https://api.nightbot.tv/1/channel/send/abc'),
+        user=NightbotUser(
+            name='user', displayName='User', provider='discord', providerId=user_id, userLevel='everyone'
+        ),
+        channel=NightbotChannel(name='channel', displayName='Channel', provider='discord', providerId=channel_id),
+    )
+
+
+def is_full(throttler: Throttler) -> bool:
+    return throttler.slots is not None and throttler.slots.locked()
+
+
+class ThrottlerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_user_rate_limit(self) -> None:
+        throttler = Throttler(ThrottlingSettings(enabled=True, user_rate_limit=0.1, user_rate_limit_burst=2))
+
+        for _ in range(2):
+            async with throttler.admit(make_nightbot()):
+                pass
+
+        with self.assertRaises(CommandThrottledException) as cm:
+            async with throttler.admit(make_nightbot()):
+                pass
+        self.assertEqual(cm.exception.reason, 'user')
+        self.assertIn('10 seconds', str(cm.exception))
+
+        # Other users have buckets of their own
+        async with throttler.admit(make_nightbot(user_id='3')):
+            pass
+
+    async def test_rejected_command_takes_no_tokens(self) -> None:
+        throttler = Throttler(
+            ThrottlingSettings(
+                enabled=True,
+                user_rate_limit=0.1,
+                user_rate_limit_burst=1,
+                channel_rate_limit=0.1,
+                channel_rate_limit_burst=1,
+            )
+        )
+
+        async with throttler.admit(make_nightbot()):
+            pass
+
+        # Turned away by the channel's limit, so still within the other user's own
+        with self.assertRaises(CommandThrottledException) as cm:
+            async with throttler.admit(make_nightbot(user_id='3')):
+                pass
+        self.assertEqual(cm.exception.reason, 'channel')
+        self.assertEqual(throttler.user_buckets['discord:3'].delay(), 0.0)
+
+    async def test_overloaded(self) -> None:
+        throttler = Throttler(ThrottlingSettings(enabled=True, max_concurrency=1, max_waiting=1, max_wait=0.05))
+
+        async with throttler.admit(None):
+            # Waits for a slot, but not for long enough
+            with self.assertRaises(CommandThrottledException) as cm:
+                async with throttler.admit(None):
+                    pass
+            self.assertEqual(cm.exception.reason, 'overloaded')
+
+        async with throttler.admit(None):
+            pass
+
+    async def test_slot_held_until_deferred_reply_is_sent(self) -> None:
+        throttler = Throttler(ThrottlingSettings(enabled=True, max_concurrency=1))
+
+        sent: List[str] = []
+        nightbot_api = mock.create_autospec(NightbotAPI, instance=True)
+        nightbot_api.send_message.side_effect = lambda response_url, message: sent.append(message)
+        replies = DeferredReplies(nightbot_api, DeferredReplySettings(enabled=True, budget=0.01, placeholder='...'))
+        self.addAsyncCleanup(replies.aclose)
+
+        async def prepare() -> str:
+            await asyncio.sleep(0.1)
+            return 'message'
+
+        async with throttler.admit(None) as slot:
+            reply = await replies.reply(make_nightbot(), prepare(), lambda e: None, release=slot.hand_over())
+        self.assertEqual(reply, '...')
+        self.assertTrue(is_full(throttler))
+
+        await replies.drain()
+        self.assertEqual(sent, ['message'])
+        self.assertFalse(is_full(throttler))
+
+        # Replies not deferred give the slot back right away
+        async with throttler.admit(None) as slot:
+            reply = await replies.reply(None, prepare(), lambda e: None, release=slot.hand_over())
+        self.assertEqual(reply, 'message')
+        self.assertFalse(is_full(throttler))
+
+
+if __name__ == '__main__':
+    unittest.main()
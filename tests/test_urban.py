@@ -0,0 +1,80 @@
+import asyncio
+from typing import Dict, List
+import unittest
+from unittest import mock
+
+import httpx
+from nb4mna.api.urbandictionary import UrbanDictionaryAPI
+from nb4mna.caching import ResultCache
+from nb4mna.modules import urban
+from nb4mna.settings import settings
+
+
+class UrbanTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Autocompletions per term, terms without any have no definitions either
+        self.autocompletions: Dict[str, List[str]] = {}
+        self.requests: List[httpx.Request] = []
+
+        api = UrbanDictionaryAPI(httpx.AsyncClient(transport=httpx.MockTransport(self.respond)))
+        self.addAsyncCleanup(api.aclose)
+
+        self.patch(urban._urbandictionary, 'client', api)
+        self.patch(urban, '_term_index', None)
+        self.patch(urban, '_response_cache', ResultCache(duration=60))
+
+    def patch(self, target: object, attribute: str, value: object) -> None:
+        patcher = mock.patch.object(target, attribute, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def respond(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        await asyncio.sleep(0.01)
+
+        term = request.url.params['term']
+        if request.url.path.endswith('/autocomplete'):
+            return httpx.Response(httpx.codes.OK, json=self.autocompletions.get(term, []))
+
+        definition = {'definition': f'[{term}] defined', 'permalink': 'https://www.urbandictionary.com/x', 'word': term}
+        return httpx.Response(httpx.codes.OK, json={'list': [definition]})
+
+    def defined_terms(self) -> List[str]:
+        return [r.url.params['term'] for r in self.requests if r.url.path.endswith('/define')]
+
+    async def test_speculative_define_is_used_for_exact_match(self) -> None:
+        self.autocompletions['spam'] = ['Sam', 'spam']
+
+        with mock.patch.object(settings.urban, 'speculative_define', True):
+            message = await urban.define('spam')
+
+        self.assertIn('spam defined', message)
+        self.assertEqual(self.defined_terms(), ['spam'])
+
+    async def test_speculative_define_is_dropped_for_other_term(self) -> None:
+        self.autocompletions['sma'] = ['Sam']
+
+        with mock.patch.object(settings.urban, 'speculative_define', True):
+            message = await urban.define('sma')
+
+        self.assertIn('Sam defined', message)
+        self.assertEqual(self.defined_terms(), ['sma', 'Sam'])
+
+    async def test_response_cache_is_case_insensitive(self) -> None:
+        self.autocompletions['spam'] = ['spam']
+        self.autocompletions['Spam'] = ['spam']
+
+        first = await urban.get_message('Spam')
+        second = await urban.get_message('SPAM')
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_no_definitions_reply_echoes_each_spelling(self) -> None:
+        self.assertEqual(await urban.get_message('Nothing'), "No definitions found for 'Nothing'")
+        self.assertEqual(await urban.get_message('NOTHING'), "No definitions found for 'NOTHING'")
+        self.assertEqual(len(self.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()